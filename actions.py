@@ -1,4 +1,6 @@
-from typing import List, Union, TypeVar, Type, Tuple
+import asyncio
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List, Set, Union, TypeVar, Type, Tuple
 from loguru import logger
 from icecream import ic
 from device_inventory.models.tenant import Tenant as CoreTenant
@@ -22,12 +24,40 @@ class Actions:
     def __init__(self, db: DBClientProtocol, log: logger):
         self.db = db.db()
         self.logger = log
+        self._client_ready = False
+        self._client_lock = asyncio.Lock()
+        self._compaction_task = None
 
     async def init_client(self):
-        await self.db.init_client()
+        # Once the client is ready this is a plain flag check on the request path.
+        if self._client_ready:
+            return
+        async with self._client_lock:
+            if not self._client_ready:
+                await self.db.init_client()
+                self._client_ready = True
+
+    async def startup(self, warm_connections: int = 0, geo_tenants: List[str] = []):
+        """Build the DB client once at app startup, pre-open pool connections and preload geo dictionaries."""
+        await self.init_client()
+        if warm_connections > 0:
+            await self.db.warm_pool(warm_connections)
+        for tenant in geo_tenants:
+            await self.db.warm_geo_cache(tenant)
+
+    async def shutdown(self):
+        if self._compaction_task is not None:
+            self._compaction_task.cancel()
+            self._compaction_task = None
+        async with self._client_lock:
+            if self._client_ready:
+                await self.db.close_client()
+                self._client_ready = False
 
     async def create_tenant(self, tenant: CoreTenant) -> CoreTenant:
-        return await self.db.create_tenant(tenant)
+        new_tenant = await self.db.create_tenant(tenant)
+        self.db.invalidate_tenant_schema()
+        return new_tenant
 
     async def list_tenants(self, page: int = 0, items: int = -1, col_sort: list[str] = [], col_order: str = []) -> List[CoreTenant]:
         list_tenants = await self.db.list_tenants(page, items, col_sort, col_order)
@@ -55,36 +85,32 @@ class Actions:
         return await self.db.get_tenant(tenant_id)
 
     async def check_tenant(self, tenant_info: dict) -> Union[str, None]:
-        exist_by_header = None
-        if 'header' in tenant_info:
-            exist_by_header = await self.db.get_tenant_schema(tenant_info['header'])
-
-        exist_by_hostname = await self.db.get_tenant_schema(tenant_info['hostname'])
-
-        # Tenant Not Found
-        if exist_by_header is None and exist_by_hostname is None:
-            return None
-
-        # Find a tenant only by hostname
-        if exist_by_header is None and exist_by_hostname is not None:
-            return tenant_info['hostname']
-
-        # Find a tenant only by header
-        if exist_by_header is not None and exist_by_hostname is None:
-            return tenant_info['header']
-
-        # Find Tenant by both method but are different
-        if exist_by_header != exist_by_hostname:
-            return None
+        tenant, reason = await self.db.resolve_tenant(tenant_info.get('header'), tenant_info.get('hostname'))
+        if tenant is None:
+            self.logger.debug(f'Tenant rejected ({reason}): {tenant_info}')
+        return tenant
 
     async def get_tenant_by_name(self, tenant_name: str) -> CoreTenant:
         return await self.db.get_tenant_by_name(tenant_name)
 
     async def edit_tenant(self, tenant_id: str, new_tenant: TenantUpdate) -> CoreTenant:
-        return await self.db.edit_tenant(tenant_id, new_tenant)
+        edited = await self.db.edit_tenant(tenant_id, new_tenant)
+        self.db.invalidate_tenant_schema()
+        return edited
     
     async def delete_tenant(self, tenant_id: str) -> bool:
-        return await self.db.delete_tenant(tenant_id)
+        deleted = await self.db.delete_tenant(tenant_id)
+        self.db.invalidate_tenant_schema()
+        return deleted
+
+    def tenant_cache_stats(self) -> dict:
+        return self.db.tenant_schema_cache_stats()
+
+    def site_cache_stats(self) -> dict:
+        return self.db.site_cache_stats()
+
+    def geo_cache_stats(self) -> dict:
+        return self.db.geo_cache_stats()
 
     async def list_devices(self, tenant: str, page: int = 0, limit: int = -1) -> List[Device]:
         return await self.db.list_devices(tenant, page, limit)
@@ -116,48 +142,131 @@ class Actions:
             ic('no hay tenant')
             raise TenantNotFound
     
-    async def get_site(self, tenant_info: dict, site_key: str) -> Site:
+    async def create_sites(self, tenant_info: dict, sites: List[Site], origin: str, chunk_size: int = 1000, upsert: bool = False) -> List[dict]:
+        await self.init_client()
+        check_tenant = await self.check_tenant(tenant_info)
+        if check_tenant is not None:
+            return await self.db.create_sites(check_tenant, sites, origin, chunk_size=chunk_size, upsert=upsert)
+        else:
+            raise TenantNotFound
+
+    async def upsert_site(self, tenant_info: dict, site: Site, origin: str) -> dict:
+        await self.init_client()
+        check_tenant = await self.check_tenant(tenant_info)
+        if check_tenant is not None:
+            return await self.db.upsert_site(check_tenant, site, origin)
+        else:
+            raise TenantNotFound
+
+    async def get_site(self, tenant_info: dict, site_key: str, fields: Set[str] = None, as_of: datetime = None) -> Site:
         await self.init_client()
         check_tenant = await self.check_tenant(tenant_info)
         ic(check_tenant)
         if check_tenant is not None:
-            output = await self.db.get_site(check_tenant, site_key)
+            output = await self.db.get_site(check_tenant, site_key, fields=fields, as_of=as_of)
             return output
         return None
     
+    async def get_sites(self, tenant_info: dict, site_keys: List[str], fields: Set[str] = None) -> Dict[str, Tuple[Site, List[Device]]]:
+        await self.init_client()
+        check_tenant = await self.check_tenant(tenant_info)
+        if check_tenant is not None:
+            return await self.db.get_sites(check_tenant, site_keys, fields=fields)
+        raise TenantNotFound
+    
     async def edit_site(self, tenant_info: dict, site: Site, site_key: str,origin: str) -> Site:
         await self.init_client()
         check_tenant = await self.check_tenant(tenant_info)
         ic(check_tenant)
         if check_tenant is not None:
-            return await self.db.edit_site(check_tenant, site, site_key, origin)
+            return await self.db.edit_site(check_tenant, site_key, site, origin)
         return None
 
-    async def list_sites(self, tenant_info: dict, page: int = 0, items: int = -1) -> List[Site]:
+    async def edit_sites(self, tenant_info: dict, edits: List[Tuple[str, dict]], origin: str, chunk_size: int = 1000) -> List[dict]:
         await self.init_client()
         check_tenant = await self.check_tenant(tenant_info)
         if check_tenant is not None:
-            list_sites = await self.db.list_sites(check_tenant, page, items)        
-            total_pages = ceil(list_sites['total_records'] / items)
-            if(items == -1): total_pages = 0
-
-            has_previous_page = False
-            if(page > 1): has_previous_page = True
+            return await self.db.edit_sites(check_tenant, edits, origin, chunk_size=chunk_size)
+        else:
+            raise TenantNotFound
 
-            has_next_page = False
-            if(total_pages > page):
-                has_next_page = True
-    
-            return {
+    async def list_sites(self, tenant_info: dict, page: int = 0, items: int = -1, col_sort: list[str] = [], col_order: list[str] = [],
+                         first: int = None, after: str = None, count_mode: str = 'exact', fields: Set[str] = None,
+                         as_of: datetime = None) -> List[Site]:
+        await self.init_client()
+        check_tenant = await self.check_tenant(tenant_info)
+        if check_tenant is not None:
+            list_sites = await self.db.list_sites(check_tenant, page, items, col_sort, col_order,
+                                                  first=first, after=after, count_mode=count_mode, fields=fields,
+                                                  as_of=as_of)
+            total_records = list_sites['total_records']
+            page_size = first if first is not None else items
+
+            # Without a count there is no way to know how many pages there are
+            total_pages = None
+            if total_records is not None:
+                total_pages = ceil(total_records / page_size) if page_size > 0 else 0
+
+            if first is not None:
+                # Keyset pagination, pages are walked by cursor
+                has_previous_page = after is not None
+            else:
+                has_previous_page = False
+                if(page > 1): has_previous_page = True
+
+            output = {
                 'records' : list_sites['records'],
-                'total_records' : list_sites['total_records'],
-                'page' : page,
+                'total_records' : total_records,
+                'page' : page if first is None else 0,
                 'total_pages' : total_pages,
+                'count_mode' : count_mode.lower(),
                 'has_previous_page' : has_previous_page,
-                'has_next_page' : has_next_page
+                'has_next_page' : list_sites['has_next_page']
             }
+            if first is not None:
+                output['end_cursor'] = list_sites['end_cursor']
+            return output
         return None
 
+    async def site_changes(self, tenant_info: dict, since: str = None, limit: int = 1000) -> dict:
+        await self.init_client()
+        check_tenant = await self.check_tenant(tenant_info)
+        if check_tenant is None:
+            raise TenantNotFound
+        return await self.db.site_changes(check_tenant, since=since, limit=limit)
+
+    async def compact_site_history(self, tenant_info: dict, retention_days: int = None, batch_size: int = None) -> Dict[str, int]:
+        await self.init_client()
+        check_tenant = await self.check_tenant(tenant_info)
+        if check_tenant is None:
+            raise TenantNotFound
+        retention = timedelta(days=retention_days) if retention_days is not None else None
+        return await self.db.compact_site_history(check_tenant, retention=retention, batch_size=batch_size)
+
+    def start_history_compaction(self, tenants: List[str], interval: float = 3600, retention_days: int = None) -> asyncio.Task:
+        """Compact the site history of tenants every interval seconds in the background, stopped by shutdown."""
+        retention = timedelta(days=retention_days) if retention_days is not None else None
+
+        async def run():
+            while True:
+                for tenant in tenants:
+                    try:
+                        await self.db.compact_site_history(tenant, retention=retention)
+                    except Exception as e:
+                        self.logger.error(f'Site history compaction of {tenant} failed:\n{e}')
+                await asyncio.sleep(interval)
+
+        self._compaction_task = asyncio.create_task(run())
+        return self._compaction_task
+
+    async def iter_sites(self, tenant_info: dict, chunk_size: int = 1000) -> AsyncIterator[List[dict]]:
+        await self.init_client()
+        check_tenant = await self.check_tenant(tenant_info)
+        if check_tenant is None:
+            raise TenantNotFound
+        async for batch in self.db.iter_sites(check_tenant, chunk_size):
+            yield batch
+
     async def delete_site(self, tenant_info: dict, site_key: str) -> None:
         await self.init_client()
         check_tenant = await self.check_tenant(tenant_info)
@@ -172,9 +281,10 @@ class Actions:
         check_tenant = await self.check_tenant(tenant_info)
         if check_tenant is not None:
             devices = await self.keys_to_models(check_tenant, keys, pydantic_model=Device, sqlalchemy_model=HubDevice, sqlalchemy_field='hub_device_key')
-            res = await self.db.add_devices_to_site(check_tenant, site, devices, origin)
+            # The written state comes back from the same transaction
+            res = await self.db.add_devices_to_site(check_tenant, site, devices, origin, with_state=True)
             if res:
-                return await self.db.get_site(check_tenant, site.site_key)
+                return res
         else:
             raise TenantNotFound
     
@@ -185,10 +295,10 @@ class Actions:
         ic(check_tenant)
         if check_tenant is not None:
             devices = await self.keys_to_models(check_tenant, keys, pydantic_model=Device, sqlalchemy_model=HubDevice, sqlalchemy_field='hub_device_key')
-            res = await self.db.remove_devices_from_site(check_tenant, site, devices)
+            res = await self.db.remove_devices_from_site(check_tenant, site, devices, with_state=True)
             ic(res)
             if res:
-                return await self.db.get_site(check_tenant, site.site_key)
+                return res
         else:
             return None
     
@@ -197,7 +307,9 @@ class Actions:
         check_tenant = await self.check_tenant(tenant_info)
         ic(check_tenant)
         if check_tenant is not None:
-            return await self.db.create_country(check_tenant, country, origin)
+            new_country = await self.db.create_country(check_tenant, country, origin)
+            await self.db.invalidate_geo_cache(check_tenant)
+            return new_country
         else:
             raise TenantNotFound
 
@@ -224,7 +336,9 @@ class Actions:
         check_tenant = await self.check_tenant(tenant_info)
         ic(check_tenant)
         if check_tenant is not None:
-            return await self.db.create_state(check_tenant, state, origin)
+            new_state = await self.db.create_state(check_tenant, state, origin)
+            await self.db.invalidate_geo_cache(check_tenant)
+            return new_state
         else:
             raise TenantNotFound
     
@@ -251,7 +365,9 @@ class Actions:
         check_tenant = await self.check_tenant(tenant_info)
         ic(check_tenant)
         if check_tenant is not None:
-            return await self.db.create_municipality(check_tenant, municipality, origin)
+            new_municipality = await self.db.create_municipality(check_tenant, municipality, origin)
+            await self.db.invalidate_geo_cache(check_tenant)
+            return new_municipality
         else:
             raise TenantNotFound
 
@@ -278,7 +394,9 @@ class Actions:
         check_tenant = await self.check_tenant(tenant_info)
         ic(check_tenant)
         if check_tenant is not None:
-            return await self.db.create_city(check_tenant, city, origin)
+            new_city = await self.db.create_city(check_tenant, city, origin)
+            await self.db.invalidate_geo_cache(check_tenant)
+            return new_city
         else:
             raise TenantNotFound
     
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from itertools import count
+from time import monotonic
+from typing import Any, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """In-process cache with a time to live and an optional LRU size bound.
+
+    Entries expire ``ttl`` seconds after being stored. When ``maxsize`` is set
+    the least recently used entry is evicted once the bound is reached.
+    ``None`` is a valid value, so unknown keys can be cached as negative
+    entries; use ``lookup`` to tell a cached ``None`` apart from a miss.
+
+    Read-through callers take ``generation(key)`` before loading and pass it to
+    ``set``: an invalidation in between bumps the generation and the stale
+    value is not stored.
+    """
+
+    # Generations remembered per key, older ones are folded into a floor
+    GENERATIONS_SIZE = 10000
+
+    def __init__(self, ttl: float, maxsize: Optional[int] = None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._counter = count(1)
+        self._generations: OrderedDict = OrderedDict()
+        # Every forgotten generation is at most the floor, so a load that
+        # started before it can't match a key that is no longer tracked
+        self._floor = 0
+
+    def lookup(self, key: Hashable) -> Tuple[bool, Any]:
+        """Return ``(found, value)`` and update the hit/miss counters."""
+        entry = self._data.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self._data[key]
+        self.misses += 1
+        return False, None
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        found, value = self.lookup(key)
+        return value if found else default
+
+    def generation(self, key: Hashable) -> int:
+        return self._generations.get(key, self._floor)
+
+    def _bump(self, key: Hashable) -> None:
+        self._generations[key] = next(self._counter)
+        self._generations.move_to_end(key)
+        while len(self._generations) > self.GENERATIONS_SIZE:
+            _, generation = self._generations.popitem(last=False)
+            self._floor = max(self._floor, generation)
+
+    def _bump_all(self) -> None:
+        self._generations.clear()
+        self._floor = next(self._counter)
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, generation: Optional[int] = None) -> None:
+        """Store value, unless generation is given and key was invalidated since it was taken."""
+        if generation is not None and generation != self.generation(key):
+            return
+        self._data[key] = (monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+        self._bump(key)
+
+    def invalidate_where(self, predicate) -> None:
+        """Drop every entry whose key matches ``predicate``."""
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+        # Keys being loaded aren't stored yet, so every load in flight is discarded
+        self._bump_all()
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._bump_all()
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+        }
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,76 @@
+import unicodedata
+from time import monotonic
+from typing import Dict, Optional, Set
+
+
+GEO_KINDS = ('country', 'state', 'municipality', 'city')
+
+
+def normalize_geo_name(name: str) -> str:
+    """Fold accents and case and collapse whitespace, so " México" and "mexico" give the same key."""
+    decomposed = unicodedata.normalize('NFKD', name)
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(stripped.casefold().split())
+
+
+class GeoDictionary:
+    """Name <-> key maps of the geo reference data of one tenant.
+
+    Country, state, municipality and city names barely change, so site writes
+    resolve them from memory instead of querying each hub.
+    """
+
+    def __init__(self, complete: bool = False):
+        # complete: every name and site geo link of the tenant was loaded, so
+        # hierarchy checks can be answered without the database
+        self.complete = complete
+        self.loaded_at = monotonic()
+        self._keys: Dict[str, Dict[str, str]] = {kind: {} for kind in GEO_KINDS}
+        self._normalized: Dict[str, Dict[str, str]] = {kind: {} for kind in GEO_KINDS}
+        self._names: Dict[str, Dict[str, str]] = {kind: {} for kind in GEO_KINDS}
+        # key -> set of parent keys it was linked under, e.g. city -> {(country, state, municipality)}
+        self._parents: Dict[str, Dict[str, Set[tuple]]] = {kind: {} for kind in GEO_KINDS[1:]}
+
+    def add(self, kind: str, name: str, key: str) -> None:
+        self._keys[kind][name] = key
+        # Variants of an existing name keep pointing to the first row loaded
+        self._normalized[kind].setdefault(normalize_geo_name(name), key)
+        self._names[kind][key] = name
+
+    def key(self, kind: str, name: Optional[str]) -> Optional[str]:
+        """Key of an exact name, falling back to the accent-, case- and space-insensitive match."""
+        if name is None:
+            return None
+        key = self._keys[kind].get(name)
+        if key is None:
+            key = self._normalized[kind].get(normalize_geo_name(name))
+        return key
+
+    def name(self, kind: str, key: Optional[str]) -> Optional[str]:
+        if key is None:
+            return None
+        return self._names[kind].get(key)
+
+    def add_link(self, country_key: str, state_key: str, municipality_key: str, city_key: str) -> None:
+        self._parents['state'].setdefault(state_key, set()).add((country_key,))
+        self._parents['municipality'].setdefault(municipality_key, set()).add((country_key, state_key))
+        self._parents['city'].setdefault(city_key, set()).add((country_key, state_key, municipality_key))
+
+    def consistent(self, country_key: str, state_key: str, municipality_key: str, city_key: str) -> bool:
+        """A key is consistent when it was never linked under other parents than the given ones."""
+        expected = {
+            'state': (state_key, (country_key,)),
+            'municipality': (municipality_key, (country_key, state_key)),
+            'city': (city_key, (country_key, state_key, municipality_key)),
+        }
+        return all(
+            self._parents[kind].get(key, {parents}) == {parents}
+            for kind, (key, parents) in expected.items()
+        )
+
+    def age(self) -> float:
+        """Seconds since the dictionary was created."""
+        return monotonic() - self.loaded_at
+
+    def __len__(self) -> int:
+        return sum(len(keys) for keys in self._keys.values())
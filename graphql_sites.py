@@ -1,6 +1,7 @@
 import asyncio
-from typing import Any
-from graphql import GraphQLResolveInfo
+from datetime import datetime
+from typing import Any, Iterator, Set, Union
+from graphql import FieldNode, FragmentSpreadNode, GraphQLResolveInfo, InlineFragmentNode
 from icecream import ic
 from dependency_injector.wiring import inject, Provide
 from fastapi import Depends
@@ -17,6 +18,107 @@ from device_inventory.exceptions import TenantNotFound
 from device_inventory.adapters.db.models.hubDevice import HubDevice
 
 
+def parse_as_of(value: Union[str, datetime, None]) -> Union[datetime, None]:
+    """as_of arrives as an ISO 8601 string unless a DateTime scalar already parsed it."""
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is not None:
+        # Load dates are stored as naive local times
+        value = value.astimezone().replace(tzinfo=None)
+    return value
+
+
+def _field_nodes(info: GraphQLResolveInfo, selection_set) -> Iterator[FieldNode]:
+    """Yield the fields of a selection set, expanding fragments."""
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            yield selection
+        elif isinstance(selection, FragmentSpreadNode):
+            yield from _field_nodes(info, info.fragments[selection.name.value].selection_set)
+        elif isinstance(selection, InlineFragmentNode):
+            yield from _field_nodes(info, selection.selection_set)
+
+
+def selected_fields(info: GraphQLResolveInfo, *path: str) -> Set[str]:
+    """Names of the fields requested under path, e.g. ('edges', 'node') for the sites nodes."""
+    selection_sets = [node.selection_set for node in info.field_nodes]
+    for name in path:
+        selection_sets = [
+            field.selection_set
+            for selection_set in selection_sets if selection_set is not None
+            for field in _field_nodes(info, selection_set) if field.name.value == name
+        ]
+    return {
+        field.name.value
+        for selection_set in selection_sets if selection_set is not None
+        for field in _field_nodes(info, selection_set)
+    }
+
+
+class SiteLoader:
+    """Batches and deduplicates the site lookups of one GraphQL operation.
+
+    Every load() made in the same event loop tick is answered by a single
+    Actions.get_sites call. Lives in the request context, so nothing is
+    shared between operations.
+    """
+
+    def __init__(self, actions: Actions, tenant_info: dict):
+        self.actions = actions
+        self.tenant_info = tenant_info
+        self._futures = {}
+        self._queue = []
+        self._fields = set()
+        # The loop only keeps weak references to tasks, the loader holds the dispatches in flight
+        self._tasks = set()
+
+    def load(self, site_key: str, fields: Set[str] = None) -> asyncio.Future:
+        if self._fields is not None:
+            self._fields = None if fields is None else self._fields | fields
+        if site_key in self._futures:
+            return self._futures[site_key]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._futures[site_key] = future
+        self._queue.append(site_key)
+        if len(self._queue) == 1:
+            loop.call_soon(self._schedule)
+        return future
+
+    def _schedule(self):
+        task = asyncio.get_running_loop().create_task(self._dispatch())
+        self._tasks.add(task)
+        task.add_done_callback(self._dispatched)
+
+    def _dispatched(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Site loader dispatch failed: {task.exception()!r}")
+
+    async def _dispatch(self):
+        site_keys, self._queue = self._queue, []
+        fields, self._fields = self._fields, set()
+        try:
+            sites = await self.actions.get_sites(self.tenant_info, site_keys, fields=fields)
+        except Exception as e:
+            for site_key in site_keys:
+                if not self._futures[site_key].done():
+                    self._futures[site_key].set_exception(e)
+            return
+        for site_key in site_keys:
+            # Resolvers of a cancelled operation may have dropped their futures
+            if not self._futures[site_key].done():
+                self._futures[site_key].set_result(sites.get(site_key))
+
+
+def site_loader(info: GraphQLResolveInfo, actions: Actions) -> SiteLoader:
+    if "site_loader" not in info.context:
+        info.context["site_loader"] = SiteLoader(actions, info.context["tenant_info"])
+    return info.context["site_loader"]
+
+
 @query.field("sites")
 @tenant_info
 @inject
@@ -31,7 +133,10 @@ async def resolve_list_sites(
 
     tenant_info = info.context["tenant_info"]
     
-    int(data["items"])
+    if "items" in data:
+        data["items"] = int(data["items"])
+    if "as_of" in data:
+        data["as_of"] = parse_as_of(data["as_of"])
     success = False
 
     # Setup response
@@ -46,8 +151,9 @@ async def resolve_list_sites(
         "has_next_page": False,
     }
 
-    # Start list
-    site_data = await actions.list_sites(tenant_info, **data)
+    # Start list, loading only what the query asks for
+    fields = selected_fields(info, 'edges', 'node')
+    site_data = await actions.list_sites(tenant_info, fields=fields, **data)
     # If a problem occurs return empty data
     if(site_data is None):
         return {
@@ -65,6 +171,7 @@ async def resolve_list_sites(
     page_info["total_pages"] = site_data['total_pages']
     page_info["has_previous_page"] = site_data['has_previous_page']
     page_info["has_next_page"] = site_data['has_next_page']
+    page_info["count_mode"] = site_data['count_mode']
     total_count = site_data['total_records']
 
     for record in site_data['records']:
@@ -114,6 +221,49 @@ async def resolve_list_sites(
         "edges": edges
     }
 
+@query.field("site_changes")
+@tenant_info
+@inject
+async def resolve_site_changes(
+        obj: Any,
+        info: GraphQLResolveInfo,
+        log: logger = Depends(Provide[ActionsContainer.logger]),
+        actions: Actions = Depends(Provide[ActionsContainer.actions]),
+        **data):
+    log.bind(request_id='GraphQL').info("resolve_site_changes")
+
+    tenant_info = info.context["tenant_info"]
+
+    response = {
+        "success": False,
+        "errors": [],
+        "watermark": data.get("since"),
+        "has_more": False,
+        "changes": []
+    }
+
+    try:
+        limit = int(data["limit"]) if data.get("limit") else 1000
+        feed = await actions.site_changes(tenant_info, since=data.get("since"), limit=limit)
+        response["changes"] = [
+            {
+                "ts": change["ts"].isoformat(),
+                "kind": change["kind"],
+                "site_key": change["site_key"],
+                "device_key": change["device_key"],
+            }
+            for change in feed["changes"]
+        ]
+        response["watermark"] = feed["watermark"]
+        response["has_more"] = feed["has_more"]
+        response["success"] = True
+    except Exception as e:
+        log.error(e)
+        response["errors"].append(str(e))
+
+    return response
+
+
 @query.field("site")
 @tenant_info
 @inject
@@ -139,7 +289,15 @@ async def resolve_get_site(
         tenant_info = info.context['tenant_info']
         device_response = []
         devices = []
-        site, devices = await actions.get_site(site_key=site_key, tenant_info=tenant_info)
+        fields = selected_fields(info, 'edge', 'node')
+        as_of = parse_as_of(data.get("as_of"))
+        if as_of is not None:
+            # Point-in-time reads are not batched with the current ones
+            result = await actions.get_site(tenant_info, site_key, fields=fields, as_of=as_of)
+        else:
+            # Aliased site fields of the same operation are fetched together
+            result = await site_loader(info, actions).load(site_key, fields)
+        site, devices = result if result is not None else (None, [])
 
         if site is None:
                 errors = [f'Site {site_key} Not Found']
@@ -195,6 +353,11 @@ async def resolve_get_site(
             errors = ['Tenant Not Found']
         elif(isinstance(e, ValueError)):
             errors = [str(e)]
+        return {
+            "success": success,
+            "errors": errors,
+            "edge": edge
+        }
     
 
 @mutation.field("create_site")
@@ -252,6 +415,86 @@ async def resolve_create_site(
 
     return response
 
+@mutation.field("create_sites")
+@tenant_info
+@inject
+async def resolve_create_sites(
+        obj: Any,
+        info: GraphQLResolveInfo,
+        log: logger = Depends(Provide[ActionsContainer.logger]),
+        actions: Actions = Depends(Provide[ActionsContainer.actions]),
+        **data):
+    log.bind(request_id='GraphQL').info("resolve_create_sites")
+
+    tenant_info = info.context["tenant_info"]
+
+    response = {
+        "success": False,
+        "errors": [],
+        "created": 0,
+        "outcomes": []
+    }
+
+    try:
+        sites = [Site(**site) for site in data['sites']]
+        chunk_size = data.get('chunk_size') or 1000
+        outcomes = await actions.create_sites(tenant_info=tenant_info, sites=sites, origin=data['origin'],
+                                              chunk_size=chunk_size, upsert=data.get('upsert') or False)
+        response["outcomes"] = [
+            {
+                "site_key": outcome["site_key"],
+                "status": outcome["status"],
+                "error": outcome["error"],
+                "node": outcome["site"],
+            }
+            for outcome in outcomes
+        ]
+        response["created"] = sum(1 for outcome in outcomes if outcome["status"] == 'created')
+        response["success"] = True
+    except Exception as e:
+        log.error(e)
+        response["errors"].append(str(e))
+
+    return response
+
+@mutation.field("edit_sites")
+@tenant_info
+@inject
+async def resolve_edit_sites(
+        obj: Any,
+        info: GraphQLResolveInfo,
+        log: logger = Depends(Provide[ActionsContainer.logger]),
+        actions: Actions = Depends(Provide[ActionsContainer.actions]),
+        **data):
+    log.bind(request_id='GraphQL').info("resolve_edit_sites")
+
+    tenant_info = info.context["tenant_info"]
+
+    response = {
+        "success": False,
+        "errors": [],
+        "updated": 0,
+        "outcomes": []
+    }
+
+    try:
+        edits = []
+        for edit in data['sites']:
+            values = dict(edit)
+            site_key = values.pop('site_key')
+            edits.append((site_key, values))
+        chunk_size = data.get('chunk_size') or 1000
+        outcomes = await actions.edit_sites(tenant_info=tenant_info, edits=edits, origin=data['origin'],
+                                            chunk_size=chunk_size)
+        response["outcomes"] = outcomes
+        response["updated"] = sum(1 for outcome in outcomes if outcome["status"] == 'updated')
+        response["success"] = True
+    except Exception as e:
+        log.error(e)
+        response["errors"].append(str(e))
+
+    return response
+
 # @mutation.field("edit_site")
 # @tenant_info
 # @inject
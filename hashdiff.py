@@ -0,0 +1,28 @@
+import hashlib
+from decimal import Decimal
+from typing import Any
+
+
+HASHDIFF_SEPARATOR = '||'
+# Postgres text can't hold NUL, so no stored value hashes like a missing one
+HASHDIFF_NULL = '\x00'
+
+
+def _canonical(value: Any) -> str:
+    if value is None:
+        return HASHDIFF_NULL
+    if isinstance(value, (float, int, Decimal)) and not isinstance(value, bool):
+        # Numbers hash by their float value, so 19.4, 19.40 and Decimal('19.4000') agree
+        return repr(float(value))
+    # Text hashes exactly as stored, a whitespace edit or '' is a change
+    return str(value)
+
+
+def hashdiff(*values: Any) -> str:
+    """md5 of the canonical values joined in order, as stored in the HASHDIFF satellite columns."""
+    return hashlib.md5(HASHDIFF_SEPARATOR.join(_canonical(value) for value in values).encode('utf-8')).hexdigest()
+
+
+def site_hashdiff(latitud: Any, longitud: Any, address: Any, zip_code: Any) -> str:
+    """Hashdiff of every SatSite attribute, in column order."""
+    return hashdiff(latitud, longitud, address, zip_code)
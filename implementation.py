@@ -1,11 +1,36 @@
-async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort: list[str] = [], col_order: list[str] = []) -> List[Site]:
+import asyncio
+from typing import AsyncIterator, Dict, Set
+from datetime import timedelta
+from sqlalchemy import String, cast, column, exists, insert, literal, null, or_, table, text, union_all, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import aliased, contains_eager, joinedload
+from device_inventory.adapters.db.cache import TTLCache
+from device_inventory.adapters.db.geo import GEO_KINDS, GeoDictionary
+from device_inventory.adapters.db.hashdiff import site_hashdiff
+
+
+async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort: list[str] = [], col_order: list[str] = [],
+                     first: int = None, after: str = None, count_mode: str = 'exact', fields: Set[str] = None,
+                     as_of: datetime = None) -> List[Site]:
         """The list_sites function returns a list of sites for the given tenant.
 
+        The total is returned along the page in a single statement. When first is given the page is read with keyset pagination: rows are
+        sought after the cursor (a site key) on the sort columns plus HUB_SITE_KEY
+        as a tiebreaker, so deep pages cost the same as the first one.
+
         Args:
             self: Access attributes and methods of the class in which it is used
             tenant:str: Specify the tenant that we want to list sites for
             page:int=0: Specify the page number of the results to be returned
             limit:int=-1: Specify how many sites to return
+            first:int=None: Page size for keyset pagination
+            after:str=None: Cursor (site key) of the last site of the previous page
+            count_mode:str='exact': 'exact' counts in the same statement as the page,
+                'estimated' reads the planner statistics of the whole site hub (as_of
+                and sorting are not applied) and 'none' skips counting, leaving the
+                total None
+            fields:Set[str]=None: Site fields to load, None loads everything
+            as_of:datetime=None: List the sites as they were at this time, see get_site
 
         Returns:
             A list of site objects
@@ -13,7 +38,7 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
         Doc Author:
             Trelent
         """
-        schema = await self.get_tenant_schema(tenant)
+        schema = await self.cached_tenant_schema(tenant)
         if schema is None:
             raise TenantNotFound()
 
@@ -22,80 +47,111 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
 
             try:
 
-                # Get the metrics for the query
-                count_query = select(func.count('*')).order_by(None).select_from(HubSite)
-                count_results = await session.execute(count_query)
-                count = count_results.scalars().first()
-                expected_pages = count / limit
-                if(page > expected_pages and page > 0):
-                    raise ValueError(
-                        "The page number is higher than the expected pages."
-                    )
-
-                query = select(HubSite)
+                count_mode = count_mode.lower()
+                if count_mode not in ('exact', 'estimated', 'none'):
+                    raise ValueError(f"Unknown count mode {count_mode}.")
 
-                # Validate columns sort
-                if len(col_sort) != len(col_order):
-                    raise ValueError(
-                        "The col_sort and col_order lists must have the same length."
-                    )
+                if as_of is not None and col_sort:
+                    raise ValueError("Sorting is not supported on point-in-time reads.")
 
-                # Sort data if is need it
+                # The exact total rides along in the page query as a scalar subquery
+                total_count = self._site_count_query(as_of, join_sat=bool(col_sort)).scalar_subquery()
+                query = select(HubSite, total_count) if count_mode == 'exact' else select(HubSite)
+                if as_of is not None:
+                    query = query.where(HubSite.HUB_LOAD_DATE <= as_of)
+                sort_columns = self._site_sort_columns(col_sort, col_order)
                 if(col_sort):
-                    order_functions = []
-                    # Merge both lists and loop through them.
-                    for column, direction in zip(col_sort, col_order):
-
-                        if(hasattr(HubSite,column)):
-                            attr = getattr(HubSite, column)
-                        else:
-                            if(hasattr(SatSite,column) == False):
-                                raise ProcessingError('Site has no attribute ' + column)
-
-                            attr = getattr(SatSite, column)
-
-                        order = desc(attr) if direction == 'DESC' else asc(attr)
-
-                        order_functions.append(order)
-
                     query = query.join(HubSite.sat_info)
-                    query = query.order_by(*order_functions)
 
-                # Paginate data
-                if limit > 0:
-                    query = query\
-                        .limit(limit)\
-                        .offset(page * limit)
+                if first is not None:
+                    # Keyset pagination, HUB_SITE_KEY makes the order total
+                    sort_columns.append((HubSite.HUB_SITE_KEY, 'ASC'))
+                    if after is not None:
+                        anchor_query = select(*[attr for attr, direction in sort_columns]).where(
+                            HubSite.HUB_SITE_KEY == after
+                        )
+                        if(col_sort):
+                            anchor_query = anchor_query.select_from(HubSite).join(HubSite.sat_info)
+                        anchor_results = await session.execute(anchor_query)
+                        anchor = anchor_results.first()
+                        if anchor is None:
+                            raise ValueError(f"The cursor {after} does not exist.")
+                        query = query.where(self._keyset_predicate(sort_columns, anchor))
+                    query = query.order_by(*self._sort_order(sort_columns))
+                    page_size = first
+                else:
+                    # Sort data if is need it
+                    if(sort_columns):
+                        query = query.order_by(*self._sort_order(sort_columns))
+
+                    # Paginate data
+                    page_size = limit if limit > 0 else None
+                    if page_size is not None:
+                        query = query.offset(page * limit)
+
+                # One extra row tells if there is a next page without counting
+                if page_size is not None:
+                    query = query.limit(page_size + 1)
+
+                # Fixed number of queries per page: satellite and geo ride along the page
+                # query, devices are loaded with one IN query per relationship
+                # Point-in-time pages load their versions after the page query instead
+                if as_of is None and self._wants(fields, self.SITE_SAT_FIELDS):
+                    if(col_sort):
+                        # sat_info is already joined for the sort
+                        query = query.options(contains_eager(HubSite.sat_info))
+                    else:
+                        query = query.options(*self._sat_loader_options(self.SITE_PAGE_LOADER))
+                if as_of is None and self._wants(fields, self.SITE_GEO_FIELDS):
+                    query = query.options(*self._geo_loader_options(self.SITE_PAGE_LOADER))
+                if as_of is None and self._wants(fields, self.SITE_DEVICE_FIELDS):
+                    query = query.options(*self._device_loader_options(self.SITE_PAGE_LOADER))
 
                 results = await session.execute(query)
+                rows = results.unique().all()
+                hub_sites = [row[0] for row in rows]
+                has_next_page = False
+                if page_size is not None:
+                    has_next_page = len(hub_sites) > page_size
+                    hub_sites = hub_sites[:page_size]
+
+                count = None
+                if count_mode == 'exact':
+                    if rows:
+                        count = rows[0][1]
+                    else:
+                        count = await self._count_sites(session, as_of, join_sat=bool(col_sort))
+                        if(limit > 0 and page > count / limit and page > 0):
+                            raise ValueError(
+                                "The page number is higher than the expected pages."
+                            )
+                elif count_mode == 'estimated':
+                    count = await self._estimate_sites(session, schema)
+
+                if as_of is not None:
+                    site_devices = await self._sites_as_of(session, schema, hub_sites, as_of, fields)
+                else:
+                    site_devices = [
+                        (self._site_from_hub(hub_site, fields), self._devices_from_hub(hub_site, fields))
+                        for hub_site in hub_sites
+                    ]
+
                 result_list = []
-                for site in results.scalars().unique():
-                    devices_keys = [device.HUB_DEVICE_HUB_DEVICE_KEY for device in site.linked_devices]
-                    associate_devices = await self.get_multiple_devices(tenant, devices_keys)
-                    # if site.sat_info and site.sat_info.SAT_LOAD_DATE != site.sat_info.LOAD_END_DATE:
-                    #     continue
-                    site = Site(
-                        site_key=site.HUB_SITE_KEY,
-                        name=site.NAME,
-                        latitud=site.sat_info.LATITUD if site.sat_info is not None else None,
-                        longitud=site.sat_info.LONGITUD if site.sat_info is not None else None,
-                        address=site.sat_info.ADDRESS if site.sat_info is not None else None,
-                        zip_code=site.sat_info.ZIP_CODE if site.sat_info is not None else None,
-                        country=site.site_info.hub_country.NAME if site.site_info is not None else None,
-                        state=site.site_info.hub_state.NAME if site.site_info is not None else None,
-                        municipality=site.site_info.hub_municipality.NAME if site.site_info is not None else None,
-                        city=site.site_info.hub_city.CITY if site.site_info is not None else None,
-                        )
+                for site, associate_devices in site_devices:
                     result_dict = {
                         "site": site
                     }
                     if associate_devices:
                         result_dict["devices"] = associate_devices
                     result_list.append(result_dict)
-                return {
+                output = {
                     'records' : result_list,
-                    'total_records' : count
+                    'total_records' : count,
+                    'has_next_page' : has_next_page
                 }
+                if first is not None:
+                    output['end_cursor'] = hub_sites[-1].HUB_SITE_KEY if hub_sites else None
+                return output
             except Exception as e:
                 self.logger.error(e)
                 if(isinstance(e,ProcessingError)):
@@ -104,16 +160,63 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
                     raise e
                 return {
                     'records' : [],
-                    'total_records' : 0
+                    'total_records' : 0,
+                    'has_next_page' : False
                 }
 
-    async def get_site(self, tenant: str, site_key: str) -> Tuple[Site, List[Device]]:
+    async def iter_sites(self, tenant: str, chunk_size: int = 1000) -> AsyncIterator[List[dict]]:
+        """The iter_sites function streams every site of a tenant in batches.
+
+        Rows come from a server-side cursor and the session identity map is
+        emptied after each batch, so memory stays flat regardless of tenant size.
+
+        Args:
+            self: Access the class attributes
+            tenant:str: Specify the tenant to export
+            chunk_size:int=1000: Sites per yielded batch
+
+        Returns:
+            An async iterator of lists of {"site": Site, "devices": [Device]}
+        """
+        schema = await self.cached_tenant_schema(tenant)
+        if schema is None:
+            raise TenantNotFound()
+
+        async with self.__session() as session:
+            await session.connection(execution_options={"schema_translate_map": {"TENANT_NAME": schema}})
+            # selectinload runs once per partition, keyed on that partition's sites
+            query = select(HubSite).order_by(HubSite.HUB_SITE_KEY).options(
+                *self._sat_loader_options(),
+                *self._geo_loader_options(),
+                *self._device_loader_options(self.SITE_PAGE_LOADER),
+            ).execution_options(yield_per=chunk_size)
+
+            results = await session.stream(query)
+            async for partition in results.scalars().partitions(chunk_size):
+                batch = [
+                    {
+                        "site": self._site_from_hub(hub_site),
+                        "devices": self._devices_from_hub(hub_site)
+                    }
+                    for hub_site in partition
+                ]
+                session.expunge_all()
+                yield batch
+
+    async def get_site(self, tenant: str, site_key: str, fields: Set[str] = None, as_of: datetime = None) -> Tuple[Site, List[Device]]:
         """The get_site function returns a Site object for the specified tenant and site key.
 
+        Full reads go through a tenant-scoped LRU cache that every site write path
+        invalidates. The cached objects are shared, callers must not mutate them.
+
         Args:
             self: Access the class attributes
             tenant:str: Specify the tenant that we want to get a site from
             site_key:str: Specify the site to be retrieved
+            fields:Set[str]=None: Site fields to load, None loads everything
+            as_of:datetime=None: Read the site as it was at this time: the satellite
+                version and the geo and device links that were open then. Devices
+                are returned with their current attributes. Bypasses the cache
 
         Returns:
             A site object
@@ -121,30 +224,34 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
         Doc Author:
             Trelent
         """
-        schema = await self.get_tenant_schema(tenant)
+        schema = await self.cached_tenant_schema(tenant)
         if schema is None:
             raise TenantNotFound()
 
+        # Cached entries are full reads, they answer any projection
+        found, cached = self.site_cache.lookup((schema, site_key)) if as_of is None else (False, None)
+        if found:
+            return cached
+        # A write that invalidates the key while this read runs keeps its result out of the cache
+        generation = self.site_cache.generation((schema, site_key))
+
         async with self.__session() as session:
             await session.connection(execution_options={"schema_translate_map": {"TENANT_NAME": schema}})
             try:
-                options = [
-                    selectinload(HubSite.sat_info),
-                    selectinload(HubSite.linked_devices).\
-                        selectinload(LinkSiteDevice.device).\
-                        selectinload(HubDevice.device_gen_info),
-                    selectinload(HubSite.linked_devices).\
-                        selectinload(LinkSiteDevice.device).\
-                        selectinload(HubDevice.ssh_config),
-                    selectinload(HubSite.site_info).\
-                        selectinload(LinkSiteCountryStateMunicipality.hub_country),
-                    selectinload(HubSite.site_info).\
-                        selectinload(LinkSiteCountryStateMunicipality.hub_state),
-                    selectinload(HubSite.site_info).\
-                        selectinload(LinkSiteCountryStateMunicipality.hub_municipality),
-                    selectinload(HubSite.site_info).\
-                        selectinload(LinkSiteCountryStateMunicipality.hub_city)
-                ]
+                if as_of is not None:
+                    query = select(HubSite).where(and_(
+                        HubSite.HUB_SITE_KEY == site_key,
+                        HubSite.HUB_LOAD_DATE <= as_of
+                    ))
+                    results = await session.execute(query)
+                    result = results.scalars().first()
+                    if result is None:
+                        self.logger.info('Site does not exists')
+                        return None
+                    return (await self._sites_as_of(session, schema, [result], as_of, fields))[0]
+
+                # Site, satellite and geo in one joined statement, devices in a second one
+                options = self._site_loader_options(fields, self.SITE_READ_LOADER)
 
                 query = select(
                         HubSite
@@ -156,34 +263,10 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
                 if result is None:
                     self.logger.info('Site does not exists')
                     return None
-                output_site = Site(
-                            site_key=result.HUB_SITE_KEY,
-                            name=result.NAME,
-                            latitud=result.sat_info.LATITUD if result.sat_info is not None else None,
-                            longitud=result.sat_info.LONGITUD if result.sat_info is not None else None,
-                            address=result.sat_info.ADDRESS if result.sat_info is not None else None,
-                            zip_code=result.sat_info.ZIP_CODE if result.sat_info is not None else None,
-                            country=result.site_info.hub_country.NAME if result.site_info is not None else None,
-                            state=result.site_info.hub_state.NAME if result.site_info is not None else None,
-                            municipality=result.site_info.hub_municipality.NAME if result.site_info is not None else None,
-                            city=result.site_info.hub_city.CITY if result.site_info is not None else None
-                        )      
-                devices = []
-                for linked_device in result.linked_devices:
-                    dev = linked_device.device  # Acceder a la relación device para cada LinkedDevice
-                    if dev:
-                        output_device = Device(
-                            vendor=dev.VENDOR if dev is not None else None,
-                            serial_number=dev.SERIAL_NUMBER if dev is not None else None,
-                            hostname=dev.device_gen_info.HOSTNAME if dev.device_gen_info is not None else None,
-                            description=dev.device_gen_info.DESCRIPTION if dev.device_gen_info is not None else None,
-                            status=dev.device_gen_info.STATUS if dev.device_gen_info is not None else None,
-                            cypher=dev.ssh_config.CYPHER if dev.ssh_config is not None else None,
-                            host_key_algorithm=dev.ssh_config.HOST_KEY_ALGORITHM if dev.ssh_config is not None else None,
-                            mac=dev.ssh_config.MAC if dev.ssh_config is not None else None,
-                            device_type=dev.ssh_config.DEVICE_TYPE if dev.ssh_config is not None else None,
-                            )
-                        devices.append(output_device)
+                output_site = self._site_from_hub(result, fields)
+                devices = self._devices_from_hub(result, fields)
+                if fields is None:
+                    self.site_cache.set((schema, site_key), (output_site, devices), generation=generation)
                 return output_site, devices
             except Exception as e:
                 # TODO: Mejorar las excepciones de aca!
@@ -194,6 +277,58 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
                 self.logger.error(f'Can\'t find site for {site_key}, because:\n{e}')
                 return None
 
+    async def get_sites(self, tenant: str, site_keys: List[str], fields: Set[str] = None) -> Dict[str, Tuple[Site, List[Device]]]:
+        """The get_sites function returns many sites of a tenant with a fixed number of queries.
+
+        Cached sites are served from memory and the rest are loaded together with
+        the same loader plan as get_site, so N sites cost two statements.
+
+        Args:
+            self: Access the class attributes
+            tenant:str: Specify the tenant that we want to get the sites from
+            site_keys:List[str]: Keys of the sites to be retrieved
+            fields:Set[str]=None: Site fields to load, None loads everything
+
+        Returns:
+            A dict site_key -> (Site, [Device]), sites that don't exist are left out
+        """
+        schema = await self.cached_tenant_schema(tenant)
+        if schema is None:
+            raise TenantNotFound()
+
+        output = {}
+        missing = []
+        generations = {}
+        for site_key in dict.fromkeys(site_keys):
+            found, cached = self.site_cache.lookup((schema, site_key))
+            if found:
+                output[site_key] = cached
+            else:
+                missing.append(site_key)
+                generations[site_key] = self.site_cache.generation((schema, site_key))
+        if not missing:
+            return output
+
+        async with self.__session() as session:
+            await session.connection(execution_options={"schema_translate_map": {"TENANT_NAME": schema}})
+            try:
+                query = select(HubSite).where(
+                    HubSite.HUB_SITE_KEY.in_(missing)
+                ).options(*self._site_loader_options(fields, self.SITE_READ_LOADER))
+                results = await session.execute(query)
+                for hub_site in results.scalars().unique():
+                    site_devices = (self._site_from_hub(hub_site, fields), self._devices_from_hub(hub_site, fields))
+                    if fields is None:
+                        self.site_cache.set((schema, hub_site.HUB_SITE_KEY), site_devices,
+                                            generation=generations[hub_site.HUB_SITE_KEY])
+                    output[hub_site.HUB_SITE_KEY] = site_devices
+            except Exception as e:
+                if isinstance(e, ConnectionRefusedError):
+                    self.logger.error(f'Can\'t connect to server:\n{e}')
+                else:
+                    self.logger.error(f'Can\'t find sites {missing}, because:\n{e}')
+        return output
+
     async def create_site(self, tenant: str, site: Site, origin: str) -> Site:
         """The create_site function creates a new site in the specified tenant.
 
@@ -212,7 +347,7 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
         if (site.latitud is None and site.longitud is not None) or (site.latitud is not None and site.longitud is None):
             raise CoordinatesError('Latitude or longitude not defined')
 
-        schema = await self.get_tenant_schema(tenant)
+        schema = await self.cached_tenant_schema(tenant)
         if schema is None:
             raise TenantNotFound()
 
@@ -222,14 +357,15 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
                 await session.connection(execution_options={"schema_translate_map": {"TENANT_NAME": schema}})
                 try:
                     self.logger.debug('Creating HubSite object')
-                    new_site = HubSite(
-                        HUB_SITE_KEY=site.site_key,
-                        NAME=site.name,
-                        HUB_RECORD_SRC=origin,
-                        HUB_LOAD_DATE=now
-                    )
-                    self.logger.debug(f'Adding Site {new_site}')
-                    session.add(new_site)
+                    # A duplicate is skipped by the database instead of failing the transaction
+                    query = pg_insert(HubSite).values(self._hub_row(site, origin, now)).on_conflict_do_nothing(
+                        index_elements=[HubSite.HUB_SITE_KEY]
+                    ).returning(HubSite.HUB_SITE_KEY)
+                    results = await session.execute(query)
+                    if results.first() is None:
+                        self.logger.error(f'Can\'t create site:\n({site}), because:\nThe site already exist')
+                        return None
+                    new_sat = None
                     if site.address is not None or (site.latitud is not None and site.longitud is not None):
                         self.logger.debug('Creating SatSite object')
                         new_sat = SatSite(
@@ -238,34 +374,41 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
                             LONGITUD=site.longitud,
                             ADDRESS=site.address,
                             ZIP_CODE=site.zip_code,
+                            HASHDIFF=self._site_hashdiff(site),
                             SAT_RECORD_SRC=origin,
                             SAT_LOAD_DATE=now,
                             LOAD_END_DATE=now,
                         )
                         session.add(new_sat)
                         self.logger.debug(f'New SatSite {new_sat}')
+                    new_link = None
                     if site.country is not None and site.state is not None \
                         and site.municipality is not None and site.city is not None:
-                        country = await self.get_country_by_name(tenant, site.country)
-                        state = await self.get_state_by_name(tenant, site.state)
-                        mun = await self.get_municipality_by_name(tenant, site.municipality)
-                        city = await self.get_city_by_name(tenant, site.city)
-                        if country is not None and state is not None \
-                            and mun is not None and city is not None:
+                        geo_keys, consistent = await self.resolve_geo(tenant, site.country, site.state, site.municipality, site.city)
+                        if None not in geo_keys:
+                            country_key, state_key, mun_key, city_key = geo_keys
+                            if not consistent:
+                                self.logger.warning(f'Site {site.site_key} links {site.city}, {site.municipality}, '
+                                                    f'{site.state}, {site.country} against the existing geo hierarchy')
                             new_link = LinkSiteCountryStateMunicipality(
                                 HUB_SITE_HUB_SITE_KEY=site.site_key,
-                                HUB_COUNTRY_HUB_COUNTRY_KEY=country.country_key,
-                                HUB_STATE_HUB_STATE_KEY=state.state_key,
-                                HUB_MUNICIPALITY_HUB_MUNICIPALITY_KEY=mun.municipality_key,
-                                HUB_CITY_HUB_CITY_KEY=city.city_key,
+                                HUB_COUNTRY_HUB_COUNTRY_KEY=country_key,
+                                HUB_STATE_HUB_STATE_KEY=state_key,
+                                HUB_MUNICIPALITY_HUB_MUNICIPALITY_KEY=mun_key,
+                                HUB_CITY_HUB_CITY_KEY=city_key,
                                 LINK_LOAD_DATE=now,
                                 LINK_END_DATE=now,
                                 LINK_RECORD_SRC=origin
                             )
                             session.add(new_link)
                             self.logger.debug(f'New LinkSiteCountryStateMunicipality created: {new_link}')
+                    # Flush here so a duplicate site is reported by the except below
+                    await session.flush()
+                    if new_link is not None:
+                        self._geo_linked(schema, *geo_keys)
                 except Exception as e:
                     # TODO: Mejorar las excepciones de aca!
+                    await session.rollback()
                     if isinstance(e, ConnectionRefusedError):
                         self.logger.error(f'Can\'t connect to server:\n{e}')
                     elif isinstance(e, IntegrityError):
@@ -273,8 +416,181 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
                     else:
                         self.logger.error(f'Can\'t create site:\n({site}), because:\n{e}')
                     return None
-            
-            return await self.get_site(tenant, site.site_key)
+
+            # The new site is exactly what was just written, no need to read it back
+            return self._written_site(schema, site, new_sat is not None, geo_keys if new_link is not None else None), []
+
+    async def upsert_site(self, tenant: str, site: Site, origin: str) -> dict:
+        """The upsert_site function creates a site or refreshes the attributes of an existing one.
+
+        An existing hub is left alone and a new satellite version is written only
+        when latitude, longitude, address or zip code differ from the current one,
+        so re-syncing unchanged data costs no writes.
+
+        Args:
+            self: Access the class attributes and methods
+            tenant:str: Specify the tenant that will be used for the site
+            site:Site: Site to write
+            origin:str: Specify the origin of the record
+
+        Returns:
+            The outcome dict of create_sites, with status 'created', 'updated',
+            'unchanged' or 'error'
+        """
+        if (site.latitud is None) != (site.longitud is None):
+            raise CoordinatesError('Latitude or longitude not defined')
+        outcomes = await self.create_sites(tenant, [site], origin, upsert=True)
+        return outcomes[0]
+
+    async def create_sites(self, tenant: str, sites: List[Site], origin: str, chunk_size: int = 1000, upsert: bool = False) -> List[dict]:
+        """The create_sites function creates many sites with multi-row inserts.
+
+        Coordinates are validated up front and geo names are resolved once per
+        distinct (country, state, municipality, city) tuple. Sites are written in
+        chunks of chunk_size, one transaction per chunk: a lookup of the keys that
+        already exist, then one INSERT each for hubs, satellites and geo links.
+        A failed chunk does not undo the chunks written before it.
+
+        With upsert, hubs are inserted with ON CONFLICT DO NOTHING instead of the
+        existence lookup. Sites that already exist keep their hub and geo link and
+        get a new satellite version only when their attributes differ.
+
+        Args:
+            self: Access the class attributes
+            tenant:str: Specify the tenant that will be used for the sites
+            sites:List[Site]: Sites to create
+            origin:str: Specify the origin of the records
+            chunk_size:int: Number of sites written per transaction
+            upsert:bool: Update existing sites instead of reporting them
+
+        Returns:
+            One outcome per input site, in input order: a dict with site_key,
+            status ('created', 'exists', 'duplicate', 'invalid' or 'error', and
+            'updated' or 'unchanged' instead of 'exists' with upsert), error
+            (a message or None) and site (the created Site or None)
+        """
+        schema = await self.cached_tenant_schema(tenant)
+        if schema is None:
+            raise TenantNotFound()
+
+        outcomes = [{"site_key": site.site_key, "status": None, "error": None, "site": None} for site in sites]
+        pending = []
+        seen = set()
+        for index, site in enumerate(sites):
+            if (site.latitud is None) != (site.longitud is None):
+                outcomes[index].update(status='invalid', error='Latitude or longitude not defined')
+            elif site.site_key in seen:
+                outcomes[index].update(status='duplicate', error='Site repeated in the request')
+            else:
+                seen.add(site.site_key)
+                pending.append(index)
+
+        geo_tuples = {
+            (sites[index].country, sites[index].state, sites[index].municipality, sites[index].city)
+            for index in pending
+        }
+        geo_tuples = {names for names in geo_tuples if None not in names}
+        # The first resolution loads the geo dictionary, the rest are answered from memory
+        resolutions = {names: await self.resolve_geo(tenant, *names) for names in geo_tuples}
+        for names, (geo_keys, consistent) in resolutions.items():
+            if None not in geo_keys and not consistent:
+                self.logger.warning(f'Sites link {", ".join(reversed(names))} against the existing geo hierarchy')
+
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start + chunk_size]
+            chunk_keys = [sites[index].site_key for index in chunk]
+            now = datetime.now()
+            async with self.__session() as session:
+                try:
+                    async with session.begin():
+                        await session.connection(execution_options={"schema_translate_map": {"TENANT_NAME": schema}})
+                        hub_rows, sat_rows, link_rows, written = [], [], [], []
+                        linked = set()
+                        if upsert:
+                            # Existing hubs are skipped by the database, RETURNING gives the new ones
+                            query = pg_insert(HubSite).values(
+                                [self._hub_row(sites[index], origin, now) for index in chunk]
+                            ).on_conflict_do_nothing(index_elements=[HubSite.HUB_SITE_KEY]).returning(HubSite.HUB_SITE_KEY)
+                            results = await session.execute(query)
+                            existing = set(chunk_keys) - set(results.scalars().all())
+                            current_sats = {}
+                            if existing:
+                                query = select(SatSite).where(and_(
+                                    SatSite.HUB_SITE_KEY.in_(existing),
+                                    SatSite.SAT_LOAD_DATE == SatSite.LOAD_END_DATE
+                                ))
+                                results = await session.execute(query)
+                                current_sats = {sat.HUB_SITE_KEY: sat for sat in results.scalars().all()}
+                        else:
+                            query = select(HubSite.HUB_SITE_KEY).where(HubSite.HUB_SITE_KEY.in_(chunk_keys))
+                            results = await session.execute(query)
+                            existing = set(results.scalars().all())
+
+                        closed_keys = []
+                        for index in chunk:
+                            site = sites[index]
+                            if site.site_key in existing:
+                                if not upsert:
+                                    outcomes[index].update(status='exists', error='The site already exist')
+                                elif not self._sat_differs(current_sats.get(site.site_key), site):
+                                    outcomes[index].update(status='unchanged')
+                                else:
+                                    if site.site_key in current_sats:
+                                        closed_keys.append(site.site_key)
+                                    sat_rows.append(self._sat_row(site, origin, now))
+                                    outcomes[index].update(status='updated')
+                                continue
+                            if not upsert:
+                                hub_rows.append(self._hub_row(site, origin, now))
+                            has_sat = site.address is not None or (site.latitud is not None and site.longitud is not None)
+                            if has_sat:
+                                sat_rows.append(self._sat_row(site, origin, now))
+                            geo_keys, _ = resolutions.get((site.country, site.state, site.municipality, site.city), (None, False))
+                            has_link = geo_keys is not None and None not in geo_keys
+                            if has_link:
+                                link_rows.append(dict(
+                                    HUB_SITE_HUB_SITE_KEY=site.site_key,
+                                    HUB_COUNTRY_HUB_COUNTRY_KEY=geo_keys[0],
+                                    HUB_STATE_HUB_STATE_KEY=geo_keys[1],
+                                    HUB_MUNICIPALITY_HUB_MUNICIPALITY_KEY=geo_keys[2],
+                                    HUB_CITY_HUB_CITY_KEY=geo_keys[3],
+                                    LINK_LOAD_DATE=now,
+                                    LINK_END_DATE=now,
+                                    LINK_RECORD_SRC=origin,
+                                ))
+                                linked.add(geo_keys)
+                            written.append((index, has_sat, geo_keys if has_link else None))
+
+                        if hub_rows:
+                            await session.execute(insert(HubSite), hub_rows)
+                        if closed_keys:
+                            # Close the current versions before the new ones are inserted as current
+                            await session.execute(update(SatSite).where(and_(
+                                SatSite.HUB_SITE_KEY.in_(closed_keys),
+                                SatSite.SAT_LOAD_DATE == SatSite.LOAD_END_DATE
+                            )).values(LOAD_END_DATE=now))
+                        if sat_rows:
+                            await session.execute(insert(SatSite), sat_rows)
+                        if link_rows:
+                            await session.execute(insert(LinkSiteCountryStateMunicipality), link_rows)
+                except Exception as e:
+                    if isinstance(e, ConnectionRefusedError):
+                        self.logger.error(f'Can\'t connect to server:\n{e}')
+                    else:
+                        self.logger.error(f'Can\'t create sites {chunk_keys[0]}..{chunk_keys[-1]}, because:\n{e}')
+                    for index in chunk:
+                        if outcomes[index]["status"] not in ('exists', 'unchanged'):
+                            outcomes[index].update(status='error', error=str(e))
+                    continue
+
+            for index, has_sat, geo_keys in written:
+                site = sites[index]
+                outcomes[index].update(status='created', site=self._written_site(schema, site, has_sat, geo_keys))
+            for site_key in chunk_keys:
+                self._invalidate_site(schema, site_key)
+            for geo_keys in linked:
+                self._geo_linked(schema, *geo_keys)
+        return outcomes
 
     async def edit_site(self, tenant: str, site_key: str, site: Site, origin: str) -> Site:
         """The edit_site function will update the site with the given id.
@@ -291,7 +607,7 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
         Doc Author:
             Trelent
         """
-        schema = await self.get_tenant_schema(tenant)
+        schema = await self.cached_tenant_schema(tenant)
         if schema is None:
             raise TenantNotFound()
 
@@ -299,9 +615,17 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
             async with session.begin():
                 await session.connection(execution_options={"schema_translate_map": {"TENANT_NAME": schema}})
                 try:
-                    query = select(HubSite).where(HubSite.HUB_SITE_KEY == site_key)
+                    # The geo link and the devices are not touched here, load them in this
+                    # transaction to build the result instead of reading the site again
+                    query = select(HubSite).where(HubSite.HUB_SITE_KEY == site_key).options(
+                        *self._geo_loader_options(self.SITE_READ_LOADER),
+                        *self._device_loader_options(self.SITE_READ_LOADER),
+                    )
                     results = await session.execute(query)
                     site_result = results.scalars().first()
+                    if site_result is None:
+                        self.logger.info('Site does not exists')
+                        return None
 
                     query = select(SatSite).where(and_(
                         SatSite.HUB_SITE_KEY == site_key,
@@ -309,53 +633,135 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
                     ))
                     results = await session.execute(query)
                     site_data_result = results.scalars().first()
+                    output_sat = site_data_result
 
-                    # If we don't had data in SatSite
-                    if site_data_result is None:
+                    # One hash comparison covers every satellite attribute
+                    if self._sat_differs(site_data_result, site):
                         now = datetime.now()
+                        if site_data_result is not None:
+                            # Close the current version, the new one takes over from now.
+                            # Flushed first, the current-version index is unique per site
+                            site_data_result.LOAD_END_DATE = now
+                            await session.flush()
                         new_site_data = SatSite(
                             HUB_SITE_KEY=site_key,
                             LATITUD=site.latitud,
                             LONGITUD=site.longitud,
                             ADDRESS=site.address,
+                            ZIP_CODE=site.zip_code,
+                            HASHDIFF=self._site_hashdiff(site),
                             SAT_LOAD_DATE=now,
                             LOAD_END_DATE=now,
                             SAT_RECORD_SRC=origin
                         )
                         session.add(new_site_data)
-                        await session.commit()
-                        
-                    else:
-                        change = False
-
-                        if site_data_result.LATITUD != site.latitud:
-                            change = True
-                        if site_data_result.LONGITUD != site.longitud:
-                            change = True
-                        if site_data_result.ADDRESS != site.address:
-                            change = True
-
-                        if change:
-                            now = datetime.now()
-                            new_site_data = SatSite(
-                                HUB_SITE_KEY=site.site_key,
-                                SAT_LOAD_DATE=now,
-                                LATITUD=site.latitud if site.latitud is not None else None,
-                                LONGITUD=site.longitud if site.longitud is not None else None,
-                                ADDRESS=site.address if site.address is not None else None,
-                                LOAD_END_DATE=now,
-                                SAT_RECORD_SRC=origin
-                            )
-                            # ATENCION:
-                            # Ojo con esto, estoy dejando que el cambio se realice cuando la sesión termine y el sqlalchemy
-                            # haga el commit. No sé si esto es lo más óptimo.
-                            session.add(new_site_data)
-                            await session.commit()
+                        output_sat = new_site_data
+
+                    # Built before the commit expires the loaded rows
+                    output = (
+                        self._site_from_parts(site_result, output_sat, site_result.site_info),
+                        self._devices_from_hub(site_result)
+                    )
+                    await session.commit()
                 except Exception as e:
                     self.logger.error(f'Exception:\n{e}')
                     return None
                 
-                return await self.get_site(tenant=tenant, site_key=site.site_key)
+                self._invalidate_site(schema, site_key)
+                return output
+
+    async def edit_sites(self, tenant: str, edits: List[Tuple[str, dict]], origin: str, chunk_size: int = 1000) -> List[dict]:
+        """The edit_sites function applies many site edits with set-based satellite versioning.
+
+        Per chunk of chunk_size edits, in one transaction: one query loads the
+        hubs with their current satellite, changes are detected by hashdiff,
+        one UPDATE closes the changed versions and one multi-row INSERT writes
+        the new ones. Like edit_site, only the satellite attributes are edited:
+        each edit carries latitud, longitud, address and zip_code, a missing
+        one is written as None.
+
+        Args:
+            self: Access the class attributes
+            tenant:str: Specify the tenant
+            edits:List[Tuple[str, dict]]: (site_key, satellite values) pairs
+            origin:str: Specify the origin of the records
+            chunk_size:int: Number of edits written per transaction
+
+        Returns:
+            One outcome per edit, in input order: a dict with site_key, status
+            ('updated', 'unchanged', 'not_found', 'duplicate', 'invalid' or
+            'error') and error (a message or None)
+        """
+        schema = await self.cached_tenant_schema(tenant)
+        if schema is None:
+            raise TenantNotFound()
+
+        outcomes = [{"site_key": site_key, "status": None, "error": None} for site_key, _ in edits]
+        values = [{field: edit.get(field) for field in self.SITE_SAT_FIELDS} for _, edit in edits]
+        pending = []
+        seen = set()
+        for index, (site_key, edit) in enumerate(edits):
+            if not edit.keys() <= self.SITE_SAT_FIELDS:
+                outcomes[index].update(status='invalid', error=f'Only {", ".join(sorted(self.SITE_SAT_FIELDS))} can be edited')
+            elif (values[index]['latitud'] is None) != (values[index]['longitud'] is None):
+                outcomes[index].update(status='invalid', error='Latitude or longitude not defined')
+            elif site_key in seen:
+                outcomes[index].update(status='duplicate', error='Site repeated in the request')
+            else:
+                seen.add(site_key)
+                pending.append(index)
+
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start + chunk_size]
+            chunk_keys = [edits[index][0] for index in chunk]
+            now = datetime.now()
+            updated = []
+            async with self.__session() as session:
+                try:
+                    async with session.begin():
+                        await session.connection(execution_options={"schema_translate_map": {"TENANT_NAME": schema}})
+                        query = select(HubSite.HUB_SITE_KEY, SatSite).outerjoin(SatSite, and_(
+                            SatSite.HUB_SITE_KEY == HubSite.HUB_SITE_KEY,
+                            SatSite.SAT_LOAD_DATE == SatSite.LOAD_END_DATE
+                        )).where(HubSite.HUB_SITE_KEY.in_(chunk_keys))
+                        results = await session.execute(query)
+                        current_sats = {site_key: sat for site_key, sat in results.all()}
+
+                        closed_keys, sat_rows = [], []
+                        for index in chunk:
+                            site_key = edits[index][0]
+                            if site_key not in current_sats:
+                                outcomes[index].update(status='not_found', error=f'Site {site_key} does not exist')
+                            elif not self._sat_values_differ(current_sats[site_key], values[index]):
+                                outcomes[index].update(status='unchanged')
+                            else:
+                                if current_sats[site_key] is not None:
+                                    closed_keys.append(site_key)
+                                sat_rows.append(self._sat_values_row(site_key, values[index], origin, now))
+                                updated.append(index)
+
+                        if closed_keys:
+                            # Close the current versions before the new ones are inserted as current
+                            await session.execute(update(SatSite).where(and_(
+                                SatSite.HUB_SITE_KEY.in_(closed_keys),
+                                SatSite.SAT_LOAD_DATE == SatSite.LOAD_END_DATE
+                            )).values(LOAD_END_DATE=now))
+                        if sat_rows:
+                            await session.execute(insert(SatSite), sat_rows)
+                except Exception as e:
+                    if isinstance(e, ConnectionRefusedError):
+                        self.logger.error(f'Can\'t connect to server:\n{e}')
+                    else:
+                        self.logger.error(f'Can\'t edit sites {chunk_keys[0]}..{chunk_keys[-1]}, because:\n{e}')
+                    for index in chunk:
+                        if outcomes[index]["status"] not in ('not_found', 'unchanged'):
+                            outcomes[index].update(status='error', error=str(e))
+                    continue
+
+            for index in updated:
+                outcomes[index].update(status='updated')
+                self._invalidate_site(schema, edits[index][0])
+        return outcomes
 
     async def delete_site(self, tenant: str, site_key: str) -> None:
         """The delete_site function deletes a site from the database.
@@ -371,7 +777,7 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
         Doc Author:
             Trelent
         """
-        schema = await self.get_tenant_schema(tenant)
+        schema = await self.cached_tenant_schema(tenant)
         if schema is None:
             raise TenantNotFound()
 
@@ -396,18 +802,20 @@ async def list_sites(self, tenant: str, page: int = 0, limit: int = -1, col_sort
                         now = datetime.now()
                         site_data_result.LOAD_END_DATE = now
                         await session.commit()
+                        self._invalidate_site(schema, site_key)
                         return True
                 except Exception as e:
                     ic(e)
                     self.logger.error(f'Exception:\n{e}')
                 return None
 
-async def add_devices_to_site(self, tenant: str, site: Site, devices: List[Device], origin: str) -> bool:
+async def add_devices_to_site(self, tenant: str, site: Site, devices: List[Device], origin: str, with_state: bool = False) -> bool:
         """
         Buscando el schema del tenant
+        Con with_state=True regresa (site, devices) con los devices ligados despues del cambio
         """
 
-        schema = await self.get_tenant_schema(tenant)
+        schema = await self.cached_tenant_schema(tenant)
         if schema is None:
             raise TenantNotFound()
 
@@ -498,6 +906,7 @@ async def add_devices_to_site(self, tenant: str, site: Site, devices: List[Devic
                 try:
                     session.add_all(linked_devices)
                     await session.commit()
+                    self._invalidate_site(schema, site.site_key)
                 except Exception as e:
                     self.logger.error(f"{e!r}")
             """
@@ -505,6 +914,16 @@ async def add_devices_to_site(self, tenant: str, site: Site, devices: List[Devic
             """
             async with session.begin():
                 await session.connection(execution_options={"schema_translate_map": {"TENANT_NAME": schema}})
+                if with_state:
+                    # The same check, answered by the linked devices that make up the result
+                    linked = await self._linked_devices(session, site.site_key)
+                    linked_keys = {hub_device.HUB_DEVICE_KEY for hub_device in linked}
+                    if not set(device_ids) <= linked_keys:
+                        raise ProcessingError(
+                            f"Couldn't add all devices to the site."
+                        )
+                    return site, [self._device_from_hub(hub_device) for hub_device in linked]
+
                 check_devices_query = select(func.count('*')).where(
                     and_(
                         LinkSiteDevice.HUB_SITE_HUB_SITE_KEY == site.site_key,
@@ -522,8 +941,8 @@ async def add_devices_to_site(self, tenant: str, site: Site, devices: List[Devic
 
                 return True
 
-    async def remove_devices_from_site(self, tenant: str, site: Site, devices: List[Device]) -> bool:
-        schema = await self.get_tenant_schema(tenant)
+    async def remove_devices_from_site(self, tenant: str, site: Site, devices: List[Device], with_state: bool = False) -> bool:
+        schema = await self.cached_tenant_schema(tenant)
         if schema is None:
             raise TenantNotFound()
 
@@ -590,22 +1009,30 @@ async def add_devices_to_site(self, tenant: str, site: Site, devices: List[Devic
 
                 """Cambiar el campo load_end_date para que adquieran el estado borrado"""
                 try:
+                    # Only the current links, closed ones are history and keep their end date
                     query_get_devices = select(LinkSiteDevice).where(and_(
                         LinkSiteDevice.HUB_SITE_HUB_SITE_KEY == site.site_key,
-                        LinkSiteDevice.HUB_DEVICE_HUB_DEVICE_KEY.in_(devices_ids)
+                        LinkSiteDevice.HUB_DEVICE_HUB_DEVICE_KEY.in_(devices_ids),
+                        LinkSiteDevice.LINK_LOAD_DATE == LinkSiteDevice.LINK_END_DATE
                     )).order_by(None)
                     now = datetime.now()
                     results_get_devices = await session.execute(query_get_devices)
                     for result_device in results_get_devices.unique().scalars():
                         result_device.LINK_END_DATE = now
+                    output = True
+                    if with_state:
+                        # Autoflush sends the closed links first, what is left is the new state
+                        remaining = await self._linked_devices(session, site.site_key)
+                        output = site, [self._device_from_hub(hub_device) for hub_device in remaining]
                     await session.commit()
-                    return True
+                    self._invalidate_site(schema, site.site_key)
+                    return output
                 except Exception as e:
                     self.logger.error(e)
                     return False
     # Este metodo funciona sobretodo para los endpoints donde solamente recibimos una lista de llaves
     async def keys_to_models(self, tenant: str, keys: Type[List], pydantic_model: Type[T], sqlalchemy_model: Type[U], sqlalchemy_field: str) -> List[T]:
-        schema = await self.get_tenant_schema(tenant)
+        schema = await self.cached_tenant_schema(tenant)
         if schema is None:
             raise TenantNotFound()
 
@@ -652,4 +1079,841 @@ async def add_devices_to_site(self, tenant: str, site: Site, devices: List[Devic
                     self.logger.error(e)
                     return None
 
-        # TODO: Falta checar que devuelva de cualquier relacion 
\ No newline at end of file
+        # TODO: Falta checar que devuelva de cualquier relacion 
+
+    def _site_count_query(self, as_of: datetime = None, join_sat: bool = False):
+        """Count of the sites a listing can return: the same as_of filter and sort join as the page."""
+        query = select(func.count('*')).select_from(HubSite).order_by(None)
+        if as_of is not None:
+            query = query.where(HubSite.HUB_LOAD_DATE <= as_of)
+        if join_sat:
+            query = query.join(HubSite.sat_info)
+        return query
+
+    async def _count_sites(self, session, as_of: datetime = None, join_sat: bool = False) -> int:
+        count_results = await session.execute(self._site_count_query(as_of, join_sat))
+        return count_results.scalars().first()
+
+    async def _estimate_sites(self, session, schema: str) -> int:
+        """Read the row estimate of the tenant's site hub from the planner statistics."""
+        estimate_results = await session.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table_name)"),
+            {"table_name": f'"{schema}"."{HubSite.__table__.name}"'}
+        )
+        estimate = estimate_results.scalars().first()
+        # Tables that were never analyzed report -1
+        if estimate is None or estimate < 0:
+            return await self._count_sites(session)
+        return estimate
+
+    async def _linked_devices(self, session, site_key: str) -> List[HubDevice]:
+        """Devices currently linked to a site, with gen info and ssh config, in one query."""
+        query = select(HubDevice).join(
+            LinkSiteDevice, LinkSiteDevice.HUB_DEVICE_HUB_DEVICE_KEY == HubDevice.HUB_DEVICE_KEY
+        ).where(and_(
+            LinkSiteDevice.HUB_SITE_HUB_SITE_KEY == site_key,
+            LinkSiteDevice.LINK_LOAD_DATE == LinkSiteDevice.LINK_END_DATE
+        )).options(
+            joinedload(HubDevice.device_gen_info),
+            joinedload(HubDevice.ssh_config)
+        )
+        results = await session.execute(query)
+        return results.scalars().unique().all()
+
+    def _site_sort_columns(self, col_sort: list[str], col_order: list[str]) -> list:
+        """Map the col_sort/col_order lists to (column, direction) pairs on HubSite or SatSite."""
+        # Validate columns sort
+        if len(col_sort) != len(col_order):
+            raise ValueError(
+                "The col_sort and col_order lists must have the same length."
+            )
+
+        sort_columns = []
+        # Merge both lists and loop through them.
+        for column, direction in zip(col_sort, col_order):
+            if(hasattr(HubSite,column)):
+                attr = getattr(HubSite, column)
+            else:
+                if(hasattr(SatSite,column) == False):
+                    raise ProcessingError('Site has no attribute ' + column)
+
+                attr = getattr(SatSite, column)
+            sort_columns.append((attr, 'DESC' if direction == 'DESC' else 'ASC'))
+        return sort_columns
+
+    def _sort_order(self, sort_columns: list) -> list:
+        # The SatSite columns are nullable, NULLs sort last in both directions so
+        # _keyset_predicate knows where they are
+        return [(desc(attr) if direction == 'DESC' else asc(attr)).nulls_last() for attr, direction in sort_columns]
+
+    def _keyset_predicate(self, sort_columns: list, anchor: tuple):
+        """Build the "comes after anchor" predicate for a mixed-direction multi-column sort.
+
+        (a, b) after (a0, b0) is a > a0 OR (a = a0 AND b > b0), with > flipped
+        to < on the DESC columns. With the NULLs last order of _sort_order every
+        NULL comes after a value and nothing comes after a NULL, so a NULL anchor
+        value matches with IS NULL instead of comparing.
+        """
+        clauses = []
+        for i, (attr, direction) in enumerate(sort_columns):
+            previous = [
+                sort_columns[j][0].is_(None) if anchor[j] is None else sort_columns[j][0] == anchor[j]
+                for j in range(i)
+            ]
+            if anchor[i] is None:
+                continue
+            seek = attr < anchor[i] if direction == 'DESC' else attr > anchor[i]
+            clauses.append(and_(*previous, or_(seek, attr.is_(None))))
+        return or_(*clauses)
+
+    # Site fields grouped by the relationship that has to be loaded to answer them
+    SITE_SAT_FIELDS = frozenset({'latitud', 'longitud', 'address', 'zip_code'})
+    SITE_GEO_FIELDS = frozenset({'country', 'state', 'municipality', 'city'})
+    SITE_DEVICE_FIELDS = frozenset({'devices'})
+
+    def _wants(self, fields: Set[str], group: frozenset) -> bool:
+        return fields is None or not group.isdisjoint(fields)
+
+    # Loader strategy for single-site reads and for pages of sites. With 'joined'
+    # sat_info and the geo branches (all many-to-one) are joined to the site query,
+    # and the device chain is one IN query with gen info and ssh config joined.
+    # 'selectin' issues one SELECT per relationship.
+    SITE_READ_LOADER = 'joined'
+    SITE_PAGE_LOADER = 'joined'
+
+    def _site_loader_options(self, fields: Set[str] = None, strategy: str = 'selectin') -> list:
+        options = []
+        if self._wants(fields, self.SITE_SAT_FIELDS):
+            options += self._sat_loader_options(strategy)
+        if self._wants(fields, self.SITE_GEO_FIELDS):
+            options += self._geo_loader_options(strategy)
+        if self._wants(fields, self.SITE_DEVICE_FIELDS):
+            options += self._device_loader_options(strategy)
+        return options
+
+    def _sat_loader_options(self, strategy: str = 'selectin') -> list:
+        if strategy == 'joined':
+            return [joinedload(HubSite.sat_info)]
+        return [selectinload(HubSite.sat_info)]
+
+    def _geo_loader_options(self, strategy: str = 'selectin') -> list:
+        if strategy == 'joined':
+            return [
+                joinedload(HubSite.site_info).\
+                    joinedload(LinkSiteCountryStateMunicipality.hub_country),
+                joinedload(HubSite.site_info).\
+                    joinedload(LinkSiteCountryStateMunicipality.hub_state),
+                joinedload(HubSite.site_info).\
+                    joinedload(LinkSiteCountryStateMunicipality.hub_municipality),
+                joinedload(HubSite.site_info).\
+                    joinedload(LinkSiteCountryStateMunicipality.hub_city)
+            ]
+        return [
+            selectinload(HubSite.site_info).\
+                selectinload(LinkSiteCountryStateMunicipality.hub_country),
+            selectinload(HubSite.site_info).\
+                selectinload(LinkSiteCountryStateMunicipality.hub_state),
+            selectinload(HubSite.site_info).\
+                selectinload(LinkSiteCountryStateMunicipality.hub_municipality),
+            selectinload(HubSite.site_info).\
+                selectinload(LinkSiteCountryStateMunicipality.hub_city)
+        ]
+
+    def _device_loader_options(self, strategy: str = 'selectin') -> list:
+        if strategy == 'joined':
+            return [
+                selectinload(HubSite.linked_devices).\
+                    joinedload(LinkSiteDevice.device).\
+                    joinedload(HubDevice.device_gen_info),
+                selectinload(HubSite.linked_devices).\
+                    joinedload(LinkSiteDevice.device).\
+                    joinedload(HubDevice.ssh_config)
+            ]
+        return [
+            selectinload(HubSite.linked_devices).\
+                selectinload(LinkSiteDevice.device).\
+                selectinload(HubDevice.device_gen_info),
+            selectinload(HubSite.linked_devices).\
+                selectinload(LinkSiteDevice.device).\
+                selectinload(HubDevice.ssh_config)
+        ]
+
+    def _valid_at(self, load_date, end_date, as_of: datetime):
+        """Versions open at as_of: loaded by then and still current or closed after it."""
+        return and_(load_date <= as_of, or_(end_date == load_date, end_date > as_of))
+
+    async def _sites_as_of(self, session, schema: str, hub_sites: List[HubSite], as_of: datetime, fields: Set[str] = None) -> List[Tuple[Site, List[Device]]]:
+        """Build the sites of hub_sites as they were at as_of, one statement per wanted relationship.
+
+        Each statement seeks the rows of the requested keys with a load date up to
+        as_of, which the (HUB_SITE_KEY, SAT_LOAD_DATE) index serves for satellites.
+        Versions moved out by compact_site_history are read from the archive tables.
+        """
+        keys = [hub_site.HUB_SITE_KEY for hub_site in hub_sites]
+        sats, geos, devices = {}, {}, {}
+        has_archive = bool(keys) and await self._has_history_archive(session, schema)
+        if keys and self._wants(fields, self.SITE_SAT_FIELDS):
+            query = select(SatSite).where(and_(
+                SatSite.HUB_SITE_KEY.in_(keys),
+                self._valid_at(SatSite.SAT_LOAD_DATE, SatSite.LOAD_END_DATE, as_of)
+            )).order_by(SatSite.SAT_LOAD_DATE)
+            results = await session.execute(query)
+            # Ordered by load date, the latest open version wins
+            for sat in results.scalars().all():
+                sats[sat.HUB_SITE_KEY] = sat
+            # Versions don't overlap, only sites without a live one can have an archived one
+            missing = [key for key in keys if key not in sats]
+            if missing and has_archive:
+                archive = self._archive_table(SatSite)
+                query = select(archive).where(and_(
+                    archive.c.HUB_SITE_KEY.in_(missing),
+                    self._valid_at(archive.c.SAT_LOAD_DATE, archive.c.LOAD_END_DATE, as_of)
+                )).order_by(archive.c.SAT_LOAD_DATE)
+                results = await session.execute(query)
+                for sat in results.all():
+                    sats[sat.HUB_SITE_KEY] = sat
+        if keys and self._wants(fields, self.SITE_GEO_FIELDS):
+            link = LinkSiteCountryStateMunicipality
+            query = select(link).where(and_(
+                link.HUB_SITE_HUB_SITE_KEY.in_(keys),
+                self._valid_at(link.LINK_LOAD_DATE, link.LINK_END_DATE, as_of)
+            )).order_by(link.LINK_LOAD_DATE).options(
+                joinedload(link.hub_country),
+                joinedload(link.hub_state),
+                joinedload(link.hub_municipality),
+                joinedload(link.hub_city),
+            )
+            results = await session.execute(query)
+            for geo in results.scalars().all():
+                geos[geo.HUB_SITE_HUB_SITE_KEY] = geo
+        if keys and self._wants(fields, self.SITE_DEVICE_FIELDS):
+            query = select(LinkSiteDevice).where(and_(
+                LinkSiteDevice.HUB_SITE_HUB_SITE_KEY.in_(keys),
+                self._valid_at(LinkSiteDevice.LINK_LOAD_DATE, LinkSiteDevice.LINK_END_DATE, as_of)
+            )).options(
+                joinedload(LinkSiteDevice.device).joinedload(HubDevice.device_gen_info),
+                joinedload(LinkSiteDevice.device).joinedload(HubDevice.ssh_config),
+            )
+            results = await session.execute(query)
+            for linked_device in results.unique().scalars().all():
+                if linked_device.device:
+                    devices.setdefault(linked_device.HUB_SITE_HUB_SITE_KEY, []).append(
+                        self._device_from_hub(linked_device.device)
+                    )
+            if has_archive:
+                archive = self._archive_table(LinkSiteDevice)
+                query = select(archive.c.HUB_SITE_HUB_SITE_KEY, archive.c.HUB_DEVICE_HUB_DEVICE_KEY).where(and_(
+                    archive.c.HUB_SITE_HUB_SITE_KEY.in_(keys),
+                    self._valid_at(archive.c.LINK_LOAD_DATE, archive.c.LINK_END_DATE, as_of)
+                ))
+                results = await session.execute(query)
+                archived_links = results.all()
+                if archived_links:
+                    query = select(HubDevice).where(
+                        HubDevice.HUB_DEVICE_KEY.in_({device_key for _, device_key in archived_links})
+                    ).options(joinedload(HubDevice.device_gen_info), joinedload(HubDevice.ssh_config))
+                    results = await session.execute(query)
+                    hub_devices = {dev.HUB_DEVICE_KEY: dev for dev in results.unique().scalars().all()}
+                    for site_key, device_key in archived_links:
+                        if device_key in hub_devices:
+                            devices.setdefault(site_key, []).append(self._device_from_hub(hub_devices[device_key]))
+        return [
+            (
+                self._site_from_parts(hub_site, sats.get(hub_site.HUB_SITE_KEY), geos.get(hub_site.HUB_SITE_KEY)),
+                devices.get(hub_site.HUB_SITE_KEY, []),
+            )
+            for hub_site in hub_sites
+        ]
+
+    def _site_from_hub(self, hub_site: HubSite, fields: Set[str] = None) -> Site:
+        # Only touch the relationships that were loaded for the requested fields
+        sat = hub_site.sat_info if self._wants(fields, self.SITE_SAT_FIELDS) else None
+        geo = hub_site.site_info if self._wants(fields, self.SITE_GEO_FIELDS) else None
+        return self._site_from_parts(hub_site, sat, geo)
+
+    def _site_from_parts(self, hub_site: HubSite, sat: SatSite, geo: LinkSiteCountryStateMunicipality) -> Site:
+        return Site(
+            site_key=hub_site.HUB_SITE_KEY,
+            name=hub_site.NAME,
+            latitud=sat.LATITUD if sat is not None else None,
+            longitud=sat.LONGITUD if sat is not None else None,
+            address=sat.ADDRESS if sat is not None else None,
+            zip_code=sat.ZIP_CODE if sat is not None else None,
+            country=geo.hub_country.NAME if geo is not None else None,
+            state=geo.hub_state.NAME if geo is not None else None,
+            municipality=geo.hub_municipality.NAME if geo is not None else None,
+            city=geo.hub_city.CITY if geo is not None else None,
+        )
+
+    def _hub_row(self, site: Site, origin: str, now: datetime) -> dict:
+        return dict(
+            HUB_SITE_KEY=site.site_key,
+            NAME=site.name,
+            HUB_RECORD_SRC=origin,
+            HUB_LOAD_DATE=now,
+        )
+
+    def _sat_values(self, site: Site) -> dict:
+        return {field: getattr(site, field) for field in self.SITE_SAT_FIELDS}
+
+    def _sat_row(self, site: Site, origin: str, now: datetime) -> dict:
+        return self._sat_values_row(site.site_key, self._sat_values(site), origin, now)
+
+    def _sat_values_row(self, site_key: str, values: dict, origin: str, now: datetime) -> dict:
+        return dict(
+            HUB_SITE_KEY=site_key,
+            LATITUD=values['latitud'],
+            LONGITUD=values['longitud'],
+            ADDRESS=values['address'],
+            ZIP_CODE=values['zip_code'],
+            HASHDIFF=self._values_hashdiff(values),
+            SAT_RECORD_SRC=origin,
+            SAT_LOAD_DATE=now,
+            LOAD_END_DATE=now,
+        )
+
+    def _site_hashdiff(self, site: Site) -> str:
+        return self._values_hashdiff(self._sat_values(site))
+
+    def _values_hashdiff(self, values: dict) -> str:
+        return site_hashdiff(values['latitud'], values['longitud'], values['address'], values['zip_code'])
+
+    def _sat_hashdiff(self, sat: SatSite) -> str:
+        # Rows written before the HASHDIFF column was backfilled hash their columns
+        return sat.HASHDIFF or site_hashdiff(sat.LATITUD, sat.LONGITUD, sat.ADDRESS, sat.ZIP_CODE)
+
+    def _sat_differs(self, sat: Union[SatSite, None], site: Site) -> bool:
+        """Whether writing site would change the current satellite version sat."""
+        return self._sat_values_differ(sat, self._sat_values(site))
+
+    def _sat_values_differ(self, sat: Union[SatSite, None], values: dict) -> bool:
+        """Whether writing the satellite values would change the current satellite version sat."""
+        if sat is None:
+            return values['address'] is not None or (values['latitud'] is not None and values['longitud'] is not None)
+        return self._sat_hashdiff(sat) != self._values_hashdiff(values)
+
+    def _written_site(self, schema: str, site: Site, has_sat: bool, geo_keys: Tuple[str, ...] = None) -> Site:
+        """Site as stored by a create, built from the input instead of reading it back.
+
+        The geo names are the stored ones of the linked keys, so a site written
+        as "mexico" comes back as "México" like a later get_site returns it.
+        """
+        geo_names = (None,) * len(GEO_KINDS)
+        if geo_keys is not None:
+            found, dictionary = self.geo_cache.lookup(schema)
+            input_names = (site.country, site.state, site.municipality, site.city)
+            geo_names = tuple(
+                (dictionary.name(kind, key) if found else None) or name
+                for kind, key, name in zip(GEO_KINDS, geo_keys, input_names)
+            )
+        country, state, municipality, city = geo_names
+        return Site(
+            site_key=site.site_key,
+            name=site.name,
+            latitud=site.latitud if has_sat else None,
+            longitud=site.longitud if has_sat else None,
+            address=site.address if has_sat else None,
+            zip_code=site.zip_code if has_sat else None,
+            country=country,
+            state=state,
+            municipality=municipality,
+            city=city,
+        )
+
+    def _device_from_hub(self, dev: HubDevice) -> Device:
+        return Device(
+            vendor=dev.VENDOR,
+            serial_number=dev.SERIAL_NUMBER,
+            hostname=dev.device_gen_info.HOSTNAME if dev.device_gen_info is not None else None,
+            description=dev.device_gen_info.DESCRIPTION if dev.device_gen_info is not None else None,
+            status=dev.device_gen_info.STATUS if dev.device_gen_info is not None else None,
+            cypher=dev.ssh_config.CYPHER if dev.ssh_config is not None else None,
+            host_key_algorithm=dev.ssh_config.HOST_KEY_ALGORITHM if dev.ssh_config is not None else None,
+            mac=dev.ssh_config.MAC if dev.ssh_config is not None else None,
+            device_type=dev.ssh_config.DEVICE_TYPE if dev.ssh_config is not None else None,
+        )
+
+    def _devices_from_hub(self, hub_site: HubSite, fields: Set[str] = None) -> List[Device]:
+        if not self._wants(fields, self.SITE_DEVICE_FIELDS):
+            return []
+        return [
+            self._device_from_hub(linked_device.device)
+            for linked_device in hub_site.linked_devices
+            if linked_device.device
+        ]
+
+    async def warm_pool(self, connections: int) -> None:
+        """The warm_pool function opens connections at startup so the first requests don't pay for them.
+
+        Every session is held until all of them are connected, so the pool ends
+        up with the requested number of distinct connections.
+
+        Args:
+            self: Access the class attributes
+            connections:int: Number of connections to pre-open
+        """
+        sessions = [self.__session() for _ in range(connections)]
+        try:
+            await asyncio.gather(*[session.execute(select(1)) for session in sessions])
+        finally:
+            await asyncio.gather(*[session.close() for session in sessions])
+
+    async def close_client(self) -> None:
+        """The close_client function disposes the engine pool on shutdown."""
+        async with self.__session() as session:
+            engine = session.bind
+        if engine is not None:
+            await engine.dispose()
+
+    # Tenant -> schema resolution is hit several times per request, cache it in process.
+    TENANT_SCHEMA_TTL = 60
+    TENANT_SCHEMA_NEGATIVE_TTL = 5
+    tenant_schema_cache = TTLCache(ttl=TENANT_SCHEMA_TTL)
+
+    async def cached_tenant_schema(self, tenant: str) -> Union[str, None]:
+        """The cached_tenant_schema function resolves a tenant to its schema through the in-process cache.
+
+        Unknown tenants are cached as negative entries with a shorter TTL, so a
+        tenant created by another process is picked up quickly.
+
+        Args:
+            self: Access the class attributes
+            tenant:str: Tenant identifier (name, hostname or header)
+
+        Returns:
+            The schema name or None if the tenant does not exist
+        """
+        found, schema = self.tenant_schema_cache.lookup(tenant)
+        if found:
+            return schema
+
+        schema = await self.get_tenant_schema(tenant)
+        ttl = self.TENANT_SCHEMA_TTL if schema is not None else self.TENANT_SCHEMA_NEGATIVE_TTL
+        self.tenant_schema_cache.set(tenant, schema, ttl=ttl)
+        return schema
+
+    def invalidate_tenant_schema(self, tenant: str = None) -> None:
+        """Drop a tenant from the schema cache, or every tenant when none is given.
+
+        A tenant can be resolved by name, hostname or header, so tenant writes
+        clear the whole cache instead of guessing which identifiers changed.
+        """
+        if tenant is None:
+            self.tenant_schema_cache.clear()
+        else:
+            self.tenant_schema_cache.invalidate(tenant)
+
+    def tenant_schema_cache_stats(self) -> dict:
+        return self.tenant_schema_cache.stats()
+
+    # Read-through cache of get_site results, keyed by (schema, site_key)
+    SITE_CACHE_TTL = 30
+    SITE_CACHE_SIZE = 10000
+    site_cache = TTLCache(ttl=SITE_CACHE_TTL, maxsize=SITE_CACHE_SIZE)
+
+    def _invalidate_site(self, schema: str, site_key: str) -> None:
+        self.site_cache.invalidate((schema, site_key))
+
+    def site_cache_stats(self) -> dict:
+        return self.site_cache.stats()
+
+    async def resolve_tenant(self, header: Union[str, None], hostname: Union[str, None]) -> Tuple[Union[str, None], Union[str, None]]:
+        """The resolve_tenant function resolves the header and hostname identifiers of a request together.
+
+        Both identifiers go through the schema cache; whatever misses is looked up
+        concurrently, so a request pays at most one round trip instead of two
+        sequential ones. A header equal to the hostname is looked up once.
+
+        Args:
+            self: Access the class attributes
+            header:str: Tenant sent in the request header, if any
+            hostname:str: Hostname the request was sent to
+
+        Returns:
+            A tuple (tenant, reason). tenant is the identifier to use for the
+            request, or None with reason 'not_found' or 'mismatch'
+        """
+        identifiers = list(dict.fromkeys(identifier for identifier in (header, hostname) if identifier is not None))
+        schemas = dict(zip(identifiers, await asyncio.gather(
+            *[self.cached_tenant_schema(identifier) for identifier in identifiers]
+        )))
+        by_header = schemas.get(header) if header is not None else None
+        by_hostname = schemas.get(hostname) if hostname is not None else None
+
+        if by_header is None and by_hostname is None:
+            return None, 'not_found'
+        if by_header is None:
+            return hostname, None
+        if by_hostname is None:
+            return header, None
+        if by_header != by_hostname:
+            return None, 'mismatch'
+        return header, None
+
+    # Country/state/municipality/city name -> key maps and geo hierarchy per schema, served to site writes from memory
+    GEO_CACHE_TTL = 300
+    # Minimum age in seconds of a dictionary before a name it misses reloads it
+    GEO_MISS_RELOAD = 2
+    geo_cache = TTLCache(ttl=GEO_CACHE_TTL)
+
+    async def geo_dictionary(self, tenant: str) -> GeoDictionary:
+        """The geo_dictionary function returns the geo name/key maps of a tenant, loading them on a cache miss.
+
+        The four hubs and the current site geo links are read in a single
+        session; the links give the hierarchy resolve_geo checks against.
+
+        Args:
+            self: Access the class attributes
+            tenant:str: Specify the tenant to load
+
+        Returns:
+            A GeoDictionary with every country, state, municipality and city of the tenant
+        """
+        schema = await self.cached_tenant_schema(tenant)
+        if schema is None:
+            raise TenantNotFound()
+
+        found, dictionary = self.geo_cache.lookup(schema)
+        if found and dictionary.complete:
+            return dictionary
+
+        dictionary = GeoDictionary(complete=True)
+        async with self.__session() as session:
+            await session.connection(execution_options={"schema_translate_map": {"TENANT_NAME": schema}})
+            queries = {
+                'country': select(HubCountry.HUB_COUNTRY_KEY, HubCountry.NAME),
+                'state': select(HubState.HUB_STATE_KEY, HubState.NAME),
+                'municipality': select(HubMunicipality.HUB_MUNICIPALITY_KEY, HubMunicipality.NAME),
+                'city': select(HubCity.HUB_CITY_KEY, HubCity.CITY),
+            }
+            for kind in GEO_KINDS:
+                results = await session.execute(queries[kind])
+                for key, name in results.all():
+                    dictionary.add(kind, name, key)
+            link = LinkSiteCountryStateMunicipality
+            results = await session.execute(select(
+                link.HUB_COUNTRY_HUB_COUNTRY_KEY,
+                link.HUB_STATE_HUB_STATE_KEY,
+                link.HUB_MUNICIPALITY_HUB_MUNICIPALITY_KEY,
+                link.HUB_CITY_HUB_CITY_KEY,
+            ).where(link.LINK_LOAD_DATE == link.LINK_END_DATE).distinct())
+            for link_keys in results.all():
+                dictionary.add_link(*link_keys)
+        self.geo_cache.set(schema, dictionary)
+        return dictionary
+
+    async def resolve_geo(self, tenant: str, country: str, state: str, municipality: str, city: str) -> Tuple[Tuple[Union[str, None], ...], bool]:
+        """The resolve_geo function maps geo names to hub keys and checks them against the geo hierarchy.
+
+        The hierarchy is the one recorded by the current site geo links: a city
+        already linked under another municipality, state or country, or a
+        municipality or state linked under other parents, makes the tuple
+        inconsistent. The first call of a tenant loads its whole geo dictionary
+        (see geo_dictionary) and later calls answer from memory. A name the
+        dictionary does not know may have been created since it was loaded, e.g.
+        by another worker, so a miss drops and reloads the dictionary and looks
+        the names up again. Reloads happen at most once per GEO_MISS_RELOAD
+        seconds, so unknown names in a bulk write don't reload on every site.
+        Names are matched ignoring accents, case and repeated spaces (see
+        normalize_geo_name).
+
+        Args:
+            self: Access the class attributes
+            tenant:str: Specify the tenant
+            country:str: Country name
+            state:str: State name
+            municipality:str: Municipality name
+            city:str: City name
+
+        Returns:
+            A tuple ((country_key, state_key, municipality_key, city_key), consistent),
+            with None for unknown names and consistent False in that case
+        """
+        schema = await self.cached_tenant_schema(tenant)
+        if schema is None:
+            raise TenantNotFound()
+
+        names = (country, state, municipality, city)
+        dictionary = await self.geo_dictionary(tenant)
+        keys = tuple(dictionary.key(kind, name) for kind, name in zip(GEO_KINDS, names))
+        if None in keys and dictionary.age() > self.GEO_MISS_RELOAD:
+            self.geo_cache.invalidate(schema)
+            dictionary = await self.geo_dictionary(tenant)
+            keys = tuple(dictionary.key(kind, name) for kind, name in zip(GEO_KINDS, names))
+        if None in keys:
+            return keys, False
+        return keys, dictionary.consistent(*keys)
+
+    def _geo_linked(self, schema: str, country_key: str, state_key: str, municipality_key: str, city_key: str) -> None:
+        """Record a new site geo link in the cached dictionary so later hierarchy checks see it."""
+        found, dictionary = self.geo_cache.lookup(schema)
+        if found:
+            dictionary.add_link(country_key, state_key, municipality_key, city_key)
+
+    async def warm_geo_cache(self, tenant: str) -> int:
+        """Load the geo dictionary of a tenant ahead of the first site write, returns the number of entries."""
+        return len(await self.geo_dictionary(tenant))
+
+    async def invalidate_geo_cache(self, tenant: str) -> None:
+        """Drop the geo dictionary of a tenant so the next site write reloads it."""
+        schema = await self.cached_tenant_schema(tenant)
+        if schema is not None:
+            self.geo_cache.invalidate(schema)
+
+    def geo_cache_stats(self) -> dict:
+        return self.geo_cache.stats()
+
+    # Partial indexes over the current versions, created by migrations/003_current_version_indexes.py
+    CURRENT_VERSION_INDEXES = (
+        'UX_SAT_SITE_CURRENT',
+        'IX_LINK_SITE_DEVICE_CURRENT_SITE',
+        'IX_LINK_SITE_DEVICE_CURRENT_DEVICE',
+        'IX_LINK_SITE_GEO_CURRENT_SITE',
+    )
+
+    async def missing_current_version_indexes(self, tenant: str) -> List[str]:
+        """The missing_current_version_indexes function lists the current-version indexes a tenant schema lacks.
+
+        Without UX_SAT_SITE_CURRENT nothing stops a write path from leaving two
+        current versions of a site, so deployments check this after migrating.
+
+        Args:
+            self: Access the class attributes
+            tenant:str: Specify the tenant
+
+        Returns:
+            The names of the indexes of CURRENT_VERSION_INDEXES that don't exist
+        """
+        schema = await self.cached_tenant_schema(tenant)
+        if schema is None:
+            raise TenantNotFound()
+
+        async with self.__session() as session:
+            results = await session.execute(
+                text('SELECT indexname FROM pg_indexes WHERE schemaname = :schema AND indexname = ANY(:names)'),
+                {"schema": schema, "names": list(self.CURRENT_VERSION_INDEXES)}
+            )
+            present = set(results.scalars().all())
+        return [name for name in self.CURRENT_VERSION_INDEXES if name not in present]
+
+    # Closed satellite and device link versions older than the retention window are
+    # moved to <table>_archive by compact_site_history, point-in-time reads union them
+    HISTORY_RETENTION = timedelta(days=90)
+    HISTORY_BATCH_SIZE = 5000
+    HISTORY_TABLES = (
+        (SatSite, 'HUB_SITE_KEY', 'SAT_LOAD_DATE', 'LOAD_END_DATE'),
+        (LinkSiteDevice, 'HUB_SITE_HUB_SITE_KEY', 'LINK_LOAD_DATE', 'LINK_END_DATE'),
+    )
+    # Archives are never dropped, so only their existence is cached: a schema without
+    # them is looked up in the catalog again, another worker may have created them since
+    history_archive_cache = TTLCache(ttl=300)
+
+    def _archive_table(self, model):
+        live = model.__table__
+        return table(f'{live.name}_archive', *[column(c.name) for c in live.columns], schema=live.schema)
+
+    async def _has_history_archive(self, session, schema: str) -> bool:
+        found, has_archive = self.history_archive_cache.lookup(schema)
+        if found:
+            return has_archive
+        names = [f'"{schema}"."{model.__table__.name}_archive"' for model, *_ in self.HISTORY_TABLES]
+        results = await session.execute(
+            text('SELECT bool_and(to_regclass(name) IS NOT NULL) FROM unnest(CAST(:names AS text[])) AS name'),
+            {"names": names}
+        )
+        has_archive = bool(results.scalar())
+        if has_archive:
+            self.history_archive_cache.set(schema, True)
+        return has_archive
+
+    async def _create_history_archives(self, schema: str) -> None:
+        # Every archive table in one transaction, reads union either all of them or none
+        async with self.__session() as session:
+            async with session.begin():
+                for model, site_column, load_column, _ in self.HISTORY_TABLES:
+                    name = model.__table__.name
+                    live = f'"{schema}"."{name}"'
+                    archive = f'"{schema}"."{name}_archive"'
+                    await session.execute(text(f'CREATE TABLE IF NOT EXISTS {archive} (LIKE {live} INCLUDING DEFAULTS)'))
+                    await session.execute(text(
+                        f'CREATE INDEX IF NOT EXISTS "{name}_archive_key_load" ON {archive} '
+                        f'("{site_column}", "{load_column}")'
+                    ))
+        self.history_archive_cache.set(schema, True)
+
+    async def compact_site_history(self, tenant: str, retention: timedelta = None, batch_size: int = None,
+                                   max_batches: int = None) -> Dict[str, int]:
+        """The compact_site_history function moves old closed versions out of the live history tables.
+
+        Satellite versions and device links closed before now - retention move to
+        <table>_archive in the tenant schema, created on first use. Each batch is
+        a single DELETE ... RETURNING feeding an INSERT in its own short
+        transaction, so the live tables are never locked for long and a stopped
+        run loses nothing. Current versions are never touched.
+
+        Args:
+            self: Access the class attributes
+            tenant:str: Specify the tenant to compact
+            retention:timedelta=None: Closed versions younger than this stay live, HISTORY_RETENTION by default
+            batch_size:int=None: Rows moved per transaction, HISTORY_BATCH_SIZE by default
+            max_batches:int=None: Stop after this many batches per table, None runs until done
+
+        Returns:
+            The number of rows moved per table
+        """
+        schema = await self.cached_tenant_schema(tenant)
+        if schema is None:
+            raise TenantNotFound()
+
+        cutoff = datetime.now() - (retention if retention is not None else self.HISTORY_RETENTION)
+        batch_size = batch_size or self.HISTORY_BATCH_SIZE
+        await self._create_history_archives(schema)
+        moved = {}
+        for model, _, load_column, end_column in self.HISTORY_TABLES:
+            name = model.__table__.name
+            live = f'"{schema}"."{name}"'
+            archive = f'"{schema}"."{name}_archive"'
+            columns = ', '.join(f'"{c.name}"' for c in model.__table__.columns)
+
+            moved[name] = 0
+            batches = 0
+            while max_batches is None or batches < max_batches:
+                async with self.__session() as session:
+                    async with session.begin():
+                        results = await session.execute(text(f'''
+                            WITH moved AS (
+                                DELETE FROM {live} WHERE ctid IN (
+                                    SELECT ctid FROM {live}
+                                    WHERE "{load_column}" <> "{end_column}" AND "{end_column}" < :cutoff
+                                    LIMIT :batch_size
+                                )
+                                RETURNING {columns}
+                            )
+                            INSERT INTO {archive} ({columns}) SELECT {columns} FROM moved
+                        '''), {"cutoff": cutoff, "batch_size": batch_size})
+                        count = results.rowcount
+                moved[name] += count
+                batches += 1
+                if count < batch_size:
+                    break
+            self.logger.info(f'Moved {moved[name]} closed rows of {schema}.{name} to the archive')
+        return moved
+
+    # Change feed event kinds, in the order events of the same instant are returned
+    SITE_CHANGE_KINDS = ('create', 'update', 'link', 'unlink', 'delete')
+    # Events are stamped with the writer's time before it commits, a write is
+    # expected to commit within this lag of its timestamp
+    SITE_CHANGE_LAG = timedelta(seconds=60)
+
+    def _parse_watermark(self, watermark: Union[str, None]) -> Tuple[datetime, int]:
+        if not watermark:
+            return datetime(1970, 1, 1), 0
+        try:
+            timestamp, seen = watermark.rsplit('|', 1)
+            return datetime.fromisoformat(timestamp), int(seen)
+        except ValueError:
+            raise ValueError(f"Invalid watermark {watermark}.")
+
+    async def site_changes(self, tenant: str, since: str = None, limit: int = 1000, lag: timedelta = None) -> dict:
+        """The site_changes function returns the site events recorded after a watermark.
+
+        Events are read from the history the write paths already keep:
+        create (hub load), update (satellite version loaded after the hub),
+        delete (satellite version closed without a successor), link and unlink
+        (device link load and end). Each branch is a load-date range scan, so a
+        call costs O(changes) instead of O(sites). Events are ordered by time,
+        kind, site and device; the watermark is "<time>|<events already seen at
+        that time>", so a page boundary inside one instant loses nothing. History
+        moved to the archive by compact_site_history is no longer reported.
+
+        Delivery is at least once. Events are stamped before their transaction
+        commits, so one stamped earlier can still become visible after later
+        ones were read. The watermark never moves past now - lag. Events newer
+        than that are returned but delivered again on the next call.
+        Consumers dedupe on (ts, kind, site_key, device_key).
+
+        Args:
+            self: Access the class attributes
+            tenant:str: Specify the tenant
+            since:str=None: Watermark returned by the previous call, None starts from the beginning
+            limit:int=1000: Maximum number of events to return
+            lag:timedelta=None: How far behind now the watermark stays, SITE_CHANGE_LAG by default
+
+        Returns:
+            A dict with changes (ts, kind, site_key and device_key per event),
+            watermark (pass it as since on the next call) and has_more (only
+            for events older than the lag, newer ones wait for the next poll)
+        """
+        schema = await self.cached_tenant_schema(tenant)
+        if schema is None:
+            raise TenantNotFound()
+
+        since_ts, seen = self._parse_watermark(since)
+        rank = {kind: index for index, kind in enumerate(self.SITE_CHANGE_KINDS)}
+        no_device = cast(null(), String)
+
+        def event(ts, kind, site_key, device_key=no_device):
+            return select(
+                ts.label('ts'),
+                literal(rank[kind]).label('rank'),
+                site_key.label('site_key'),
+                device_key.label('device_key'),
+            ).where(ts >= since_ts)
+
+        successor = aliased(SatSite)
+        events = union_all(
+            event(HubSite.HUB_LOAD_DATE, 'create', HubSite.HUB_SITE_KEY),
+            event(SatSite.SAT_LOAD_DATE, 'update', SatSite.HUB_SITE_KEY).join(
+                HubSite, HubSite.HUB_SITE_KEY == SatSite.HUB_SITE_KEY
+            ).where(SatSite.SAT_LOAD_DATE != HubSite.HUB_LOAD_DATE),
+            event(LinkSiteDevice.LINK_LOAD_DATE, 'link', LinkSiteDevice.HUB_SITE_HUB_SITE_KEY,
+                  LinkSiteDevice.HUB_DEVICE_HUB_DEVICE_KEY),
+            event(LinkSiteDevice.LINK_END_DATE, 'unlink', LinkSiteDevice.HUB_SITE_HUB_SITE_KEY,
+                  LinkSiteDevice.HUB_DEVICE_HUB_DEVICE_KEY).where(
+                LinkSiteDevice.LINK_END_DATE != LinkSiteDevice.LINK_LOAD_DATE
+            ),
+            # Edits close a version at the load date of the next one, deletes leave no successor
+            event(SatSite.LOAD_END_DATE, 'delete', SatSite.HUB_SITE_KEY).where(and_(
+                SatSite.LOAD_END_DATE != SatSite.SAT_LOAD_DATE,
+                ~exists().where(and_(
+                    successor.HUB_SITE_KEY == SatSite.HUB_SITE_KEY,
+                    successor.SAT_LOAD_DATE == SatSite.LOAD_END_DATE
+                ))
+            )),
+        ).subquery()
+        # The events at since_ts come first, the ones already seen are skipped
+        query = select(events).order_by(
+            events.c.ts, events.c.rank, events.c.site_key, events.c.device_key.nulls_first()
+        ).offset(seen).limit(limit + 1)
+
+        horizon = datetime.now() - (lag if lag is not None else self.SITE_CHANGE_LAG)
+        async with self.__session() as session:
+            await session.connection(execution_options={"schema_translate_map": {"TENANT_NAME": schema}})
+            results = await session.execute(query)
+            rows = results.all()
+
+        # Rows are ordered by time, the settled ones older than the horizon come first
+        settled = [row for row in rows[:limit] if row.ts < horizon]
+        has_more = len(rows) > limit and len(settled) == limit
+        rows = rows[:limit]
+        changes = [
+            {
+                "ts": row.ts,
+                "kind": self.SITE_CHANGE_KINDS[row.rank],
+                "site_key": row.site_key,
+                "device_key": row.device_key,
+            }
+            for row in rows
+        ]
+        watermark = since
+        if settled:
+            last_ts = settled[-1].ts
+            at_last = sum(1 for row in settled if row.ts == last_ts)
+            if last_ts == since_ts:
+                at_last += seen
+            watermark = f'{last_ts.isoformat()}|{at_last}'
+        return {
+            "changes": changes,
+            "watermark": watermark,
+            "has_more": has_more,
+        }
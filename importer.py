@@ -0,0 +1,257 @@
+"""Streaming site importer for CSV and JSONL files.
+
+Rows are read lazily, validated into Site models and written through
+Actions.create_sites in chunks. A bounded queue between the reader and the
+writers keeps memory flat on large files, and a checkpoint file records how
+many rows are safely written so an interrupted import can resume:
+
+    python -m device_inventory.core.importer sites.csv --tenant acme --origin cmdb
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+from time import perf_counter
+from typing import Iterator, List, Tuple, Union
+
+from loguru import logger
+from pydantic import ValidationError
+
+from device_inventory.core.actions import Actions
+from device_inventory.exceptions import TenantNotFound
+from device_inventory.models.device_properties import Site
+
+
+SITE_COLUMNS = ('name', 'latitud', 'longitud', 'address', 'zip_code', 'country', 'state', 'municipality', 'city')
+
+
+def read_rows(path: str, file_format: str = None) -> Iterator[Tuple[int, dict]]:
+    """Yield (line number, row) pairs from a CSV file with a header or a JSONL file, one row at a time.
+
+    JSONL rows are yielded as raw lines and decoded by parse_site, so a broken
+    line is reported as an invalid row instead of stopping the import.
+    """
+    if file_format is None:
+        file_format = 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+    with open(path, newline='', encoding='utf-8') as file:
+        if file_format == 'csv':
+            reader = csv.DictReader(file)
+            for row in reader:
+                yield reader.line_num, row
+        else:
+            for line_number, line in enumerate(file, start=1):
+                if line.strip():
+                    yield line_number, line
+
+
+def parse_site(row: Union[dict, str]) -> Site:
+    """Build a Site from an input row, empty cells are treated as missing values."""
+    if isinstance(row, str):
+        row = json.loads(row)
+    if not isinstance(row, dict):
+        raise ValueError('Row is not an object')
+    values = {}
+    for column in SITE_COLUMNS:
+        value = row.get(column)
+        if isinstance(value, str):
+            value = value.strip() or None
+        if value is not None:
+            values[column] = value
+    return Site(**values)
+
+
+def load_checkpoint(checkpoint_path: Union[str, None]) -> int:
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return 0
+    with open(checkpoint_path, encoding='utf-8') as file:
+        return json.load(file)['offset']
+
+
+def save_checkpoint(checkpoint_path: Union[str, None], offset: int) -> None:
+    if checkpoint_path is None:
+        return
+    # Write aside and rename so a crash never leaves a truncated checkpoint
+    tmp_path = f'{checkpoint_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump({'offset': offset}, file)
+    os.replace(tmp_path, checkpoint_path)
+
+
+class SiteImporter:
+    """Import sites from a file with bounded concurrency and resumable checkpoints.
+
+    The offset stored in the checkpoint counts input rows and only moves past a
+    chunk once it and every chunk before it are committed. A chunk whose
+    transaction failed (outcomes with status 'error') holds the checkpoint
+    back, so a resumed import writes it again. Rows of chunks that were in flight
+    during a crash are also written again on resume and come back with status
+    'exists'. The checkpoint is removed only once the whole file is committed.
+    If the reader or a writer raises, the other tasks are cancelled and the
+    error is raised from run.
+    """
+
+    def __init__(self, actions: Actions, tenant_info: dict, origin: str, chunk_size: int = 1000,
+                 max_in_flight: int = 4, writers: int = 2, checkpoint_path: str = None, log: logger = logger):
+        self.actions = actions
+        self.tenant_info = tenant_info
+        self.origin = origin
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self.writers = writers
+        self.checkpoint_path = checkpoint_path
+        self.logger = log
+
+    async def run(self, path: str, file_format: str = None) -> dict:
+        """The run function imports a file and returns the import report.
+
+        Returns:
+            A dict with rows, created, exists, failed, failed_chunks, error_rows
+            (line, name, status and error of every rejected row), resumed_from,
+            elapsed and rows_per_second
+        """
+        resumed_from = load_checkpoint(self.checkpoint_path)
+        report = {
+            'rows': 0,
+            'created': 0,
+            'exists': 0,
+            'failed': 0,
+            'failed_chunks': 0,
+            'error_rows': [],
+            'resumed_from': resumed_from,
+        }
+        queue = asyncio.Queue(maxsize=self.max_in_flight)
+        done_offsets = set()
+        checkpoint = {'offset': resumed_from, 'pending': []}
+        start = perf_counter()
+
+        async def produce():
+            chunk, lines, offset = [], [], resumed_from
+            for index, (line_number, row) in enumerate(read_rows(path, file_format)):
+                if index < resumed_from:
+                    continue
+                offset = index + 1
+                report['rows'] += 1
+                try:
+                    chunk.append(parse_site(row))
+                    lines.append(line_number)
+                except (ValidationError, TypeError, ValueError) as e:
+                    report['failed'] += 1
+                    name = row.get('name') if isinstance(row, dict) else None
+                    report['error_rows'].append({'line': line_number, 'name': name, 'status': 'invalid', 'error': str(e)})
+                if len(chunk) >= self.chunk_size:
+                    checkpoint['pending'].append(offset)
+                    # Blocks while max_in_flight chunks wait, so reading never outruns writing
+                    await queue.put((offset, chunk, lines))
+                    chunk, lines = [], []
+            checkpoint['pending'].append(offset)
+            await queue.put((offset, chunk, lines))
+            for _ in range(self.writers):
+                await queue.put(None)
+
+        async def write():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                offset, chunk, lines = item
+                committed = True
+                if chunk:
+                    outcomes = await self.actions.create_sites(self.tenant_info, chunk, self.origin, chunk_size=self.chunk_size)
+                    for line_number, site, outcome in zip(lines, chunk, outcomes):
+                        if outcome['status'] in ('created', 'exists'):
+                            report[outcome['status']] += 1
+                        else:
+                            report['failed'] += 1
+                            report['error_rows'].append({'line': line_number, 'name': site.name, 'status': outcome['status'], 'error': outcome['error']})
+                    # 'error' means the chunk transaction was rolled back
+                    committed = not any(outcome['status'] == 'error' for outcome in outcomes)
+                if not committed:
+                    report['failed_chunks'] += 1
+                    self.logger.error(f'Chunk ending at row {offset} of {path} was not written, the checkpoint stays before it')
+                    continue
+                done_offsets.add(offset)
+                advanced = False
+                while checkpoint['pending'] and checkpoint['pending'][0] in done_offsets:
+                    checkpoint['offset'] = checkpoint['pending'].pop(0)
+                    advanced = True
+                if advanced:
+                    save_checkpoint(self.checkpoint_path, checkpoint['offset'])
+                    self.logger.info(f'Imported {checkpoint["offset"]} rows of {path}')
+
+        if await self.actions.check_tenant(self.tenant_info) is None:
+            raise TenantNotFound
+        tasks = [asyncio.create_task(produce())] + [asyncio.create_task(write()) for _ in range(self.writers)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # A dead writer would leave the reader blocked on the full queue
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        # Finished imports start over next time, failed chunks resume from the checkpoint
+        if report['failed_chunks'] == 0 and self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+        report['elapsed'] = perf_counter() - start
+        report['rows_per_second'] = report['rows'] / report['elapsed'] if report['elapsed'] > 0 else 0.0
+        return report
+
+
+async def import_sites(actions: Actions, path: str, tenant: str, origin: str, file_format: str = None,
+                       chunk_size: int = 1000, max_in_flight: int = 4, checkpoint_path: str = None) -> dict:
+    await actions.init_client()
+    importer = SiteImporter(
+        actions,
+        tenant_info={'header': tenant, 'hostname': None},
+        origin=origin,
+        chunk_size=chunk_size,
+        max_in_flight=max_in_flight,
+        checkpoint_path=checkpoint_path,
+    )
+    try:
+        return await importer.run(path, file_format)
+    finally:
+        await actions.shutdown()
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Import sites from a CSV or JSONL file.')
+    parser.add_argument('path', help='CSV file with a header row, or JSONL file with one site per line')
+    parser.add_argument('--tenant', required=True, help='Tenant identifier')
+    parser.add_argument('--origin', default='import', help='Record source stored with the sites')
+    parser.add_argument('--format', dest='file_format', choices=('csv', 'jsonl'), help='Defaults to the file extension')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Sites written per transaction')
+    parser.add_argument('--in-flight', type=int, default=4, help='Chunks queued ahead of the writers')
+    parser.add_argument('--checkpoint', help='Checkpoint file, defaults to <path>.checkpoint')
+    parser.add_argument('--errors', help='Write the rejected rows to this JSONL file')
+    args = parser.parse_args(argv)
+
+    from device_inventory.core.container import ActionsContainer
+    actions = ActionsContainer().actions()
+
+    report = asyncio.run(import_sites(
+        actions, args.path, args.tenant, args.origin,
+        file_format=args.file_format,
+        chunk_size=args.chunk_size,
+        max_in_flight=args.in_flight,
+        checkpoint_path=args.checkpoint or f'{args.path}.checkpoint',
+    ))
+    if args.errors:
+        with open(args.errors, 'w', encoding='utf-8') as file:
+            for error_row in report['error_rows']:
+                file.write(json.dumps(error_row) + '\n')
+    print(
+        f"{report['rows']} rows in {report['elapsed']:.1f}s ({report['rows_per_second']:.0f} rows/s): "
+        f"{report['created']} created, {report['exists']} existing, {report['failed']} failed"
+        + (f" (resumed from row {report['resumed_from']})" if report['resumed_from'] else '')
+    )
+    for error_row in report['error_rows'][:20]:
+        print(f"  line {error_row['line']}: {error_row['status']} {error_row['error']}")
+    return 0 if report['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
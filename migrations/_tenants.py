@@ -0,0 +1,9 @@
+from sqlalchemy import text
+
+
+async def tenant_schemas(connection, table: str) -> list:
+    """Schemas holding table, i.e. every tenant schema created from the models."""
+    results = await connection.execute(text(
+        "SELECT table_schema FROM information_schema.tables WHERE table_name = :table"
+    ), {"table": table})
+    return [row[0] for row in results.all()]
@@ -0,0 +1,78 @@
+import json
+from typing import AsyncIterator, List
+
+from dependency_injector.wiring import inject, Provide
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from loguru import logger
+
+from device_inventory.core.container import ActionsContainer
+from device_inventory.core.actions import Actions
+from device_inventory.models.device import Device
+from device_inventory.models.device_properties import Site
+
+
+router = APIRouter()
+
+
+def site_record(site: Site, devices: List[Device]) -> dict:
+    return {
+        "site_key": site.site_key,
+        "name": site.name,
+        "latitud": site.latitud,
+        "longitud": site.longitud,
+        "address": site.address,
+        "zip_code": site.zip_code,
+        "country": site.country,
+        "state": site.state,
+        "municipality": site.municipality,
+        "city": site.city,
+        "devices": [
+            {
+                "device_key": device.device_key,
+                "vendor": device.vendor,
+                "serial_number": device.serial_number,
+                "hostname": device.hostname,
+                "description": device.description,
+                "status": device.status,
+                "cypher": device.cypher,
+                "host_key_algorithm": device.host_key_algorithm,
+                "mac": device.mac,
+                "device_type": device.device_type,
+            }
+            for device in devices
+        ],
+    }
+
+
+async def ndjson_sites(actions: Actions, tenant_info: dict, chunk_size: int) -> AsyncIterator[str]:
+    async for batch in actions.iter_sites(tenant_info, chunk_size=chunk_size):
+        yield "".join(
+            json.dumps(site_record(record["site"], record["devices"]), default=str) + "\n"
+            for record in batch
+        )
+
+
+@router.get("/sites/export")
+@inject
+async def export_sites(
+        request: Request,
+        chunk_size: int = 1000,
+        log: logger = Depends(Provide[ActionsContainer.logger]),
+        actions: Actions = Depends(Provide[ActionsContainer.actions])):
+    """Stream every site of the tenant as NDJSON, one site per line."""
+    log.bind(request_id='REST').info("export_sites")
+
+    tenant_info = {
+        "header": request.headers.get("tenant"),
+        "hostname": str(request.base_url),
+    }
+    # Check the tenant before the response starts, a streaming body can't change its status
+    await actions.init_client()
+    if await actions.check_tenant(tenant_info) is None:
+        return JSONResponse(status_code=404, content={"errors": ["Tenant Not Found"]})
+
+    return StreamingResponse(
+        ndjson_sites(actions, tenant_info, chunk_size),
+        media_type="application/x-ndjson",
+    )
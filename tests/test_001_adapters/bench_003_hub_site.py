@@ -0,0 +1,71 @@
+# Benchmarks for the site read paths. They are not collected with the test suite,
+# run them explicitly:
+#   python -m pytest tests/test_001_adapters/bench_003_hub_site.py -s
+import pytest
+from statistics import median
+from time import perf_counter
+
+from device_inventory.models.device_properties import Site
+from device_inventory.protocols.db import DBClientProtocol
+from test.fixture import db
+from test_003_hub_site import count_queries, ensure_geo
+
+SIZES = [100, 1000, 10000]
+REPEAT = 5
+GEO = {
+    "country": "Bench Country",
+    "state": "Bench State",
+    "municipality": "Bench Municipality",
+    "city": "Bench City",
+}
+
+
+async def seed_sites(db: DBClientProtocol, total: int):
+    """Create total bench sites with satellite data and a geo link, skipping the ones that exist."""
+    await ensure_geo(db, **GEO, origin="bench")
+    for i in range(total):
+        site = Site(name=f"bench_site_{i}", latitud=19.4 + i / total, longitud=-99.1, address=f"Bench street {i}", **GEO)
+        if await db.get_site("test2", site.site_key) is None:
+            await db.create_site(tenant="test2", site=site, origin="bench")
+
+
+async def time_list_sites(db: DBClientProtocol, limit: int) -> tuple:
+    timings = []
+    for _ in range(REPEAT):
+        with count_queries() as statements:
+            start = perf_counter()
+            await db.list_sites(tenant="test2", page=0, limit=limit, fields={'site_key', 'name', 'latitud', 'country', 'city'})
+            timings.append(perf_counter() - start)
+    return median(timings), len(statements)
+
+
+@pytest.mark.asyncio
+async def test_bench_list_sites_loaders(db: DBClientProtocol):
+    await db.init_client()
+    await seed_sites(db, max(SIZES))
+    print(f"\n{'rows':>6} {'loader':>9} {'median ms':>10} {'queries':>8}")
+    for size in SIZES:
+        for strategy in ('selectin', 'joined'):
+            db.SITE_PAGE_LOADER = strategy
+            elapsed, queries = await time_list_sites(db, size)
+            print(f"{size:>6} {strategy:>9} {elapsed * 1000:>10.1f} {queries:>8}")
+    del db.SITE_PAGE_LOADER
+
+
+@pytest.mark.asyncio
+async def test_bench_get_site_loaders(db: DBClientProtocol):
+    await db.init_client()
+    await seed_sites(db, 100)
+    site_keys = [Site(name=f"bench_site_{i}").site_key for i in range(100)]
+    print(f"\n{'loader':>9} {'median ms':>10} {'queries':>8}")
+    for strategy in ('selectin', 'joined'):
+        db.SITE_READ_LOADER = strategy
+        timings = []
+        for site_key in site_keys:
+            db.site_cache.clear()
+            with count_queries() as statements:
+                start = perf_counter()
+                await db.get_site("test2", site_key)
+                timings.append(perf_counter() - start)
+        print(f"{strategy:>9} {median(timings) * 1000:>10.2f} {len(statements):>8}")
+    del db.SITE_READ_LOADER
@@ -1,5 +1,12 @@
 import pytest
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from uuid import uuid4
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
+from device_inventory.adapters.db.models.linkSiteDevice import LinkSiteDevice
+from device_inventory.adapters.db.models.satSite import SatSite
 from device_inventory.exceptions.db_implementatation import ItemAlreadyExist, ItemDoesNotExist
 from device_inventory.models.coutry import Country
 from device_inventory.models.device import Device
@@ -304,6 +311,43 @@ async def create_site_devices(db: DBClientProtocol, tenant_info_fixture: dict, d
         output_devices.append(dev_)
     return new_site[0].site_key, output_keys, new_site[0], output_devices
 
+@contextmanager
+def count_queries():
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+
+def unique_name(prefix: str) -> str:
+    # Tests that assert exact write outcomes need sites no earlier run has written
+    return f"{prefix}_{uuid4().hex[:12]}"
+
+async def ensure_geo(db: DBClientProtocol, country: str, state: str, municipality: str, city: str,
+                     other_municipalities: list[str] = [], origin: str = "test_geo"):
+    """Create the geo reference rows of a test once, later runs find the country and skip them."""
+    if await db.get_country_by_name("test2", country) is not None:
+        return
+    await db.create_country(tenant="test2", country=Country(name=country), origin=origin)
+    await db.create_state(tenant="test2", state=State(name=state), origin=origin)
+    for name in [municipality, *other_municipalities]:
+        await db.create_municipality(tenant="test2", municipality=Municipality(name=name), origin=origin)
+    await db.create_city(tenant="test2", city=City(name=city), origin=origin)
+
+async def create_sites_with_devices(db: DBClientProtocol, prefix: str, total_sites: int, devices_per_site: int):
+    for i in range(total_sites):
+        site = Site(name=f"{prefix}_{i}", latitud=10.5 + i, longitud=20.5 + i, address=f"{prefix} street {i}")
+        new_site = await db.create_site(tenant="test2", site=site, origin="test_queries")
+        devices = []
+        for j in range(devices_per_site):
+            device = Device(vendor=f"{prefix}_vendor", serial_number=f"{prefix}{i}X{j}", status=DeviceStatus.ACTIVE)
+            devices.append(await db.create_device(tenant="test2", device=device, origin="test_queries"))
+        if new_site is not None:
+            await db.add_devices_to_site("test2", new_site[0], devices, "test_queries")
+
 @pytest.mark.asyncio
 async def test_create_minimal_site(db: DBClientProtocol, one_site):
     await db.init_client()
@@ -340,6 +384,277 @@ async def test_create_complete_site(db: DBClientProtocol, complete_site, one_dev
     assert isinstance(output[0], Site)
 
 
+@pytest.mark.asyncio
+async def test_create_site_without_read_back(db: DBClientProtocol):
+    await db.init_client()
+    await db.cached_tenant_schema("test2")
+    siteSchema = Site(name=unique_name("written_site"), latitud=19.4, longitud=-99.1, address="Written street 1", zip_code="11405")
+    with count_queries() as statements:
+        output = await db.create_site(tenant="test2", site=siteSchema, origin='test_min_db')
+    assert output[0].address == siteSchema.address
+    assert output[0].zip_code == siteSchema.zip_code
+    assert output[1] == []
+    assert not any(statement.lstrip().upper().startswith("SELECT") for statement in statements)
+
+@pytest.mark.asyncio
+async def test_link_devices_with_state(db: DBClientProtocol):
+    await db.init_client()
+    siteSchema = Site(name=unique_name("state_site"), latitud=19.4, longitud=-99.1, address="State street 1")
+    new_site = await db.create_site(tenant="test2", site=siteSchema, origin='test_state')
+    devices = []
+    for i in range(3):
+        device = Device(vendor="state_vendor", serial_number=unique_name(f"STATE{i}"), status=DeviceStatus.ACTIVE)
+        devices.append(await db.create_device(tenant="test2", device=device, origin='test_state'))
+    site, linked = await db.add_devices_to_site("test2", new_site[0], devices, "test_state", with_state=True)
+    assert site.site_key == siteSchema.site_key
+    assert len(linked) == 3
+    site, remaining = await db.remove_devices_from_site("test2", new_site[0], devices[:1], with_state=True)
+    assert len(remaining) == 2
+
+@pytest.mark.asyncio
+async def test_create_site_geo_from_memory(db: DBClientProtocol):
+    await db.init_client()
+    geo = {"country": "Geo Country", "state": "Geo State", "municipality": "Geo Municipality", "city": "Geo City"}
+    await ensure_geo(db, **geo)
+    await db.invalidate_geo_cache("test2")
+    assert await db.warm_geo_cache("test2") >= 4
+    siteSchema = Site(name=unique_name("geo_memory_site"), **geo)
+    with count_queries() as statements:
+        output = await db.create_site(tenant="test2", site=siteSchema, origin='test_geo')
+    assert output[0].country == geo["country"]
+    assert output[0].city == geo["city"]
+    assert not any(statement.lstrip().upper().startswith("SELECT") for statement in statements)
+
+@pytest.mark.asyncio
+async def test_create_sites(db: DBClientProtocol):
+    await db.init_client()
+    prefix = unique_name("bulk_site")
+    existing = Site(name=f"{prefix}_existing", address="Bulk street 0")
+    await db.create_site(tenant="test2", site=existing, origin='test_bulk')
+    sites = [Site(name=f"{prefix}_{i}", latitud=19.4, longitud=-99.1, address=f"Bulk street {i}") for i in range(1, 6)]
+    sites += [existing, Site(name=f"{prefix}_1"), Site(name=f"{prefix}_invalid", latitud=19.4)]
+    with count_queries() as statements:
+        outcomes = await db.create_sites(tenant="test2", sites=sites, origin='test_bulk', chunk_size=3)
+    assert [outcome["status"] for outcome in outcomes] == ['created'] * 5 + ['exists', 'duplicate', 'invalid']
+    assert outcomes[0]["site"].address == "Bulk street 1"
+    # Per chunk: one existence check, one hub insert and one satellite insert
+    assert len(statements) <= 2 * 3 + 2
+    assert (await db.get_site("test2", sites[4].site_key))[0].address == "Bulk street 5"
+
+@pytest.mark.asyncio
+async def test_upsert_site(db: DBClientProtocol):
+    await db.init_client()
+    name = unique_name("upsert_site")
+    site = Site(name=name, latitud=19.4, longitud=-99.1, address="Upsert street 1", zip_code="11400")
+    first = await db.upsert_site(tenant="test2", site=site, origin='test_upsert')
+    assert first["status"] == 'created'
+    again = await db.upsert_site(tenant="test2", site=site, origin='test_upsert')
+    assert again["status"] == 'unchanged'
+    moved = Site(name=name, latitud=19.4, longitud=-99.1, address="Upsert street 1", zip_code="11401")
+    changed = await db.upsert_site(tenant="test2", site=moved, origin='test_upsert')
+    assert changed["status"] == 'updated'
+    db.site_cache.clear()
+    output = await db.get_site("test2", moved.site_key)
+    assert output[0].zip_code == "11401"
+    # A duplicate create no longer fails the transaction
+    assert await db.create_site(tenant="test2", site=moved, origin='test_upsert') is None
+    outcomes = await db.create_sites(tenant="test2", sites=[moved, Site(name=f"{name}_new")], origin='test_upsert', upsert=True)
+    assert outcomes[0]["status"] == 'unchanged'
+    assert outcomes[1]["status"] == 'created'
+
+@pytest.mark.asyncio
+async def test_edit_site_zip_code(db: DBClientProtocol):
+    await db.init_client()
+    name = unique_name("hashdiff_site")
+    site = Site(name=name, latitud=19.4, longitud=-99.1, address="Hash street 1", zip_code="11400")
+    await db.create_site(tenant="test2", site=site, origin='test_hashdiff')
+    edited = Site(name=name, latitud=19.4, longitud=-99.1, address="Hash street 1", zip_code="11402")
+    output = await db.edit_site("test2", site.site_key, edited, 'test_hashdiff')
+    assert output[0].zip_code == "11402"
+    db.site_cache.clear()
+    assert (await db.get_site("test2", site.site_key))[0].zip_code == "11402"
+    # Same data again writes nothing
+    with count_queries() as statements:
+        await db.edit_site("test2", site.site_key, edited, 'test_hashdiff')
+    assert not any(statement.lstrip().upper().startswith(("INSERT", "UPDATE")) for statement in statements)
+
+@pytest.mark.asyncio
+async def test_edit_sites(db: DBClientProtocol):
+    await db.init_client()
+    prefix = unique_name("bulk_edit_site")
+    sites = [Site(name=f"{prefix}_{i}", latitud=19.4, longitud=-99.1, address=f"Bulk street {i}") for i in range(3)]
+    await db.create_sites(tenant="test2", sites=sites, origin='test_edit_sites')
+    edits = [
+        (sites[0].site_key, {"latitud": 19.5, "longitud": -99.1, "address": "Bulk street 0"}),
+        (sites[1].site_key, {"latitud": 19.4, "longitud": -99.1, "address": "Bulk street 1"}),
+        (sites[2].site_key, {"latitud": 19.4}),
+        (sites[2].site_key, {"name": "renamed"}),
+        (f"{prefix}_missing", {}),
+    ]
+    with count_queries() as statements:
+        outcomes = await db.edit_sites("test2", edits, 'test_edit_sites')
+    assert [outcome["status"] for outcome in outcomes] == ['updated', 'unchanged', 'invalid', 'invalid', 'not_found']
+    # One read, one close and one insert for the whole batch
+    assert sum(1 for statement in statements if statement.lstrip().upper().startswith(("INSERT", "UPDATE"))) == 2
+    assert (await db.get_site("test2", sites[0].site_key))[0].latitud == 19.5
+    again = await db.edit_sites("test2", edits[:1] + edits[:1], 'test_edit_sites')
+    assert [outcome["status"] for outcome in again] == ['unchanged', 'duplicate']
+
+@pytest.mark.asyncio
+async def test_get_site_as_of(db: DBClientProtocol):
+    await db.init_client()
+    name = unique_name("as_of_site")
+    site = Site(name=name, latitud=19.4, longitud=-99.1, address="Before street 1")
+    await db.create_site(tenant="test2", site=site, origin='test_as_of')
+    before_edit = datetime.now()
+    edited = Site(name=name, latitud=19.4, longitud=-99.1, address="After street 1")
+    await db.edit_site("test2", site.site_key, edited, 'test_as_of')
+    past = await db.get_site("test2", site.site_key, as_of=before_edit)
+    assert past[0].address == "Before street 1"
+    current = await db.get_site("test2", site.site_key)
+    assert current[0].address == "After street 1"
+    assert await db.get_site("test2", site.site_key, as_of=datetime(2000, 1, 1)) is None
+    listed = await db.list_sites(tenant="test2", as_of=before_edit)
+    addresses = {record["site"].site_key: record["site"].address for record in listed["records"]}
+    assert addresses[site.site_key] == "Before street 1"
+    future = await db.list_sites(tenant="test2", as_of=datetime.now() + timedelta(days=1), count_mode='none')
+    assert site.site_key in {record["site"].site_key for record in future["records"]}
+
+@pytest.mark.asyncio
+async def test_relink_device_keeps_history(db: DBClientProtocol):
+    await db.init_client()
+    prefix = f"relink_{datetime.now().timestamp()}"
+    new_site = await db.create_site(tenant="test2", site=Site(name=prefix), origin='test_relink')
+    device = await db.create_device(tenant="test2", origin='test_relink', device=Device(
+        vendor="relink_vendor", serial_number=prefix, status=DeviceStatus.ACTIVE
+    ))
+    await db.add_devices_to_site("test2", new_site[0], [device], 'test_relink')
+    first_link = datetime.now()
+    await db.remove_devices_from_site("test2", new_site[0], [device])
+    unlinked = datetime.now()
+    await db.add_devices_to_site("test2", new_site[0], [device], 'test_relink')
+    await db.remove_devices_from_site("test2", new_site[0], [device])
+    # The second unlink closes only the second link, the first interval is untouched
+    past = await db.get_site("test2", new_site[0].site_key, as_of=first_link)
+    assert [linked.device_key for linked in past[1]] == [device.device_key]
+    between = await db.get_site("test2", new_site[0].site_key, as_of=unlinked)
+    assert between[1] == []
+
+@pytest.mark.asyncio
+async def test_edit_site_keeps_one_current_version(db: DBClientProtocol):
+    await db.init_client()
+    # The guarantee below rests on the partial unique index of migrations/003
+    assert await db.missing_current_version_indexes("test2") == []
+    name = unique_name("versions_site")
+    site = Site(name=name, address="Version street 0")
+    await db.create_site(tenant="test2", site=site, origin='test_current')
+    for i in range(1, 4):
+        edited = Site(name=name, address=f"Version street {i}")
+        output = await db.edit_site("test2", site.site_key, edited, 'test_current')
+        # Fails on the unique current-version index if the previous one stayed open
+        assert output[0].address == f"Version street {i}"
+    db.site_cache.clear()
+    assert (await db.get_site("test2", site.site_key))[0].address == "Version street 3"
+
+@pytest.mark.asyncio
+async def test_compact_site_history(db: DBClientProtocol):
+    await db.init_client()
+    name = unique_name("compact_site")
+    site = Site(name=name, address="Compact street 0")
+    await db.create_site(tenant="test2", site=site, origin='test_compact')
+    before_edit = datetime.now()
+    await db.edit_site("test2", site.site_key, Site(name=name, address="Compact street 1"), 'test_compact')
+    await db.edit_site("test2", site.site_key, Site(name=name, address="Compact street 2"), 'test_compact')
+    moved = await db.compact_site_history("test2", retention=timedelta(0), batch_size=1)
+    assert moved[SatSite.__table__.name] >= 2
+    # Archived versions still answer point-in-time reads
+    past = await db.get_site("test2", site.site_key, as_of=before_edit)
+    assert past[0].address == "Compact street 0"
+    db.site_cache.clear()
+    assert (await db.get_site("test2", site.site_key))[0].address == "Compact street 2"
+    again = await db.compact_site_history("test2", retention=timedelta(0))
+    assert sum(again.values()) == 0
+
+@pytest.mark.asyncio
+async def test_compact_site_history_devices(db: DBClientProtocol):
+    await db.init_client()
+    prefix = f"compact_devices_{datetime.now().timestamp()}"
+    new_site = await db.create_site(tenant="test2", site=Site(name=prefix), origin='test_compact')
+    device = await db.create_device(tenant="test2", origin='test_compact', device=Device(
+        vendor="compact_vendor", serial_number=prefix, status=DeviceStatus.ACTIVE
+    ))
+    await db.add_devices_to_site("test2", new_site[0], [device], 'test_compact')
+    linked_at = datetime.now()
+    await db.remove_devices_from_site("test2", new_site[0], [device])
+    moved = await db.compact_site_history("test2", retention=timedelta(0))
+    assert moved[LinkSiteDevice.__table__.name] >= 1
+    # The closed link now lives in the archive and still answers point-in-time reads
+    past = await db.get_site("test2", new_site[0].site_key, as_of=linked_at)
+    assert [linked.device_key for linked in past[1]] == [device.device_key]
+    listed = await db.list_sites(tenant="test2", as_of=linked_at)
+    records = {record["site"].site_key: record for record in listed["records"]}
+    assert [linked.device_key for linked in records[new_site[0].site_key]["devices"]] == [device.device_key]
+
+@pytest.mark.asyncio
+async def test_site_changes(db: DBClientProtocol):
+    await db.init_client()
+    watermark = None
+    while True:
+        feed = await db.site_changes("test2", since=watermark, limit=1000, lag=timedelta(0))
+        watermark = feed["watermark"]
+        if not feed["has_more"]:
+            break
+    site = Site(name=f"feed_site_{datetime.now().timestamp()}", address="Feed street 0")
+    await db.create_site(tenant="test2", site=site, origin='test_feed')
+    await db.edit_site("test2", site.site_key, Site(name=site.name, address="Feed street 1"), 'test_feed')
+    await db.delete_site("test2", site.site_key)
+    # Within the commit lag the events are returned, but the watermark stays put so they come again
+    recent = await db.site_changes("test2", since=watermark)
+    assert recent["watermark"] == watermark
+    assert recent["has_more"] == False
+    again = await db.site_changes("test2", since=recent["watermark"])
+    assert again["changes"] == recent["changes"]
+    feed = await db.site_changes("test2", since=watermark, lag=timedelta(0))
+    kinds = [change["kind"] for change in feed["changes"] if change["site_key"] == site.site_key]
+    assert kinds == ['create', 'update', 'delete']
+    # Page by page gives the same events
+    paged = []
+    while True:
+        page = await db.site_changes("test2", since=watermark, limit=1, lag=timedelta(0))
+        paged += page["changes"]
+        watermark = page["watermark"]
+        if not page["has_more"]:
+            break
+    assert paged == feed["changes"]
+
+@pytest.mark.asyncio
+async def test_resolve_geo(db: DBClientProtocol):
+    await db.init_client()
+    geo = {"country": "Tree Country", "state": "Tree State", "municipality": "Tree Municipality", "city": "Tree City"}
+    await ensure_geo(db, **geo, other_municipalities=["Other Municipality"])
+    await db.create_site(tenant="test2", site=Site(name="tree_site", **geo), origin='test_geo')
+    await db.invalidate_geo_cache("test2")
+    # The first lookup loads the whole dictionary: the four hubs and the links
+    with count_queries() as statements:
+        keys, consistent = await db.resolve_geo("test2", geo["country"], geo["state"], geo["municipality"], geo["city"])
+    assert len(statements) == 5
+    assert None not in keys
+    assert consistent is True
+    # Later lookups and hierarchy checks are answered from memory
+    with count_queries() as statements:
+        # The city is already linked under another municipality
+        keys, consistent = await db.resolve_geo("test2", geo["country"], geo["state"], "Other Municipality", geo["city"])
+        assert (await db.resolve_geo("test2", geo["country"], geo["state"], geo["municipality"], geo["city"]))[1] is True
+    assert len(statements) == 0
+    assert None not in keys
+    assert consistent is False
+    # A dictionary loaded moments ago is not reloaded for names it does not know
+    with count_queries() as statements:
+        keys, consistent = await db.resolve_geo("test2", geo["country"], geo["state"], geo["municipality"], "Unknown City")
+    assert len(statements) == 0
+    assert keys[3] is None
+    assert consistent is False
+
 @pytest.mark.asyncio
 async def test_list_sites(db: DBClientProtocol, multiple_sites):
     await db.init_client()
@@ -352,6 +667,104 @@ async def test_list_sites(db: DBClientProtocol, multiple_sites):
     output = await db.list_sites(tenant="test2")
     assert output['records'] is not None
 
+@pytest.mark.asyncio
+async def test_list_sites_constant_queries(db: DBClientProtocol):
+    await db.init_client()
+    await create_sites_with_devices(db, "n1_site", total_sites=8, devices_per_site=2)
+    # Warm the tenant cache so it doesn't count for the first page
+    await db.list_sites(tenant="test2", page=0, limit=1)
+    with count_queries() as small_page:
+        small = await db.list_sites(tenant="test2", page=0, limit=2)
+    with count_queries() as big_page:
+        big = await db.list_sites(tenant="test2", page=0, limit=8)
+    assert len(small['records']) == 2
+    assert len(big['records']) == 8
+    assert len(small_page) == len(big_page)
+
+@pytest.mark.asyncio
+async def test_list_sites_single_query_without_devices(db: DBClientProtocol, multiple_sites):
+    await db.init_client()
+    for element in multiple_sites:
+        await db.create_site("test2", Site(**element), 'db_list')
+    await db.list_sites(tenant="test2", page=0, limit=1)
+    with count_queries() as statements:
+        output = await db.list_sites(tenant="test2", page=0, limit=5, fields={'site_key', 'name', 'latitud', 'country', 'city'})
+    assert len(output['records']) == 5
+    assert len(statements) == 1
+
+@pytest.mark.asyncio
+async def test_list_sites_keyset(db: DBClientProtocol):
+    await db.init_client()
+    await create_sites_with_devices(db, "ks_site", total_sites=7, devices_per_site=0)
+    for col_sort, col_order in (([], []), (["NAME"], ["DESC"]), (["LATITUD", "NAME"], ["ASC", "DESC"])):
+        seen = []
+        after = None
+        while True:
+            output = await db.list_sites(tenant="test2", col_sort=col_sort, col_order=col_order, first=3, after=after)
+            seen.extend(record['site'].site_key for record in output['records'])
+            if not output['has_next_page']:
+                break
+            after = output['end_cursor']
+        assert len(seen) == len(set(seen))
+        everything = await db.list_sites(tenant="test2", col_sort=col_sort, col_order=col_order)
+        assert len(seen) == len(everything['records'])
+
+@pytest.mark.asyncio
+async def test_list_sites_keyset_nulls(db: DBClientProtocol):
+    await db.init_client()
+    prefix = f"ks_null_{datetime.now().timestamp()}"
+    sites = [
+        Site(name=f"{prefix}_{i}", latitud=19.4, longitud=-99.1, address=f"Null street {i % 2}" if i % 3 else None,
+             zip_code="11400" if i % 2 else None)
+        for i in range(8)
+    ]
+    await db.create_sites(tenant="test2", sites=sites, origin='test_keyset_nulls')
+    for col_sort, col_order in ((["ADDRESS"], ["ASC"]), (["ADDRESS"], ["DESC"]), (["ZIP_CODE", "ADDRESS"], ["DESC", "ASC"])):
+        seen = []
+        after = None
+        while True:
+            output = await db.list_sites(tenant="test2", col_sort=col_sort, col_order=col_order, first=2, after=after)
+            seen.extend(record['site'].site_key for record in output['records'])
+            if not output['has_next_page']:
+                break
+            after = output['end_cursor']
+        assert len(seen) == len(set(seen))
+        assert {site.site_key for site in sites} <= set(seen)
+        everything = await db.list_sites(tenant="test2", col_sort=col_sort, col_order=col_order)
+        assert len(seen) == len(everything['records'])
+
+@pytest.mark.asyncio
+async def test_list_sites_count_modes(db: DBClientProtocol):
+    await db.init_client()
+    await create_sites_with_devices(db, "cm_site", total_sites=3, devices_per_site=0)
+    everything = await db.list_sites(tenant="test2", limit=-1)
+    exact = await db.list_sites(tenant="test2", page=0, limit=2, count_mode='exact')
+    assert exact['total_records'] == len(everything['records'])
+    assert exact['has_next_page'] == True
+    estimated = await db.list_sites(tenant="test2", page=0, limit=2, count_mode='estimated')
+    assert estimated['total_records'] is not None
+    with count_queries() as statements:
+        none = await db.list_sites(tenant="test2", page=0, limit=2, count_mode='none')
+    assert none['total_records'] is None
+    assert none['has_next_page'] == True
+    assert not any('count(' in statement.lower() for statement in statements)
+
+@pytest.mark.asyncio
+async def test_list_sites_total_matches_filters(db: DBClientProtocol):
+    await db.init_client()
+    await create_sites_with_devices(db, "cm_site", total_sites=3, devices_per_site=0)
+    # Sorting joins the satellite, the total only counts the sites the listing can return
+    sorted_sites = await db.list_sites(tenant="test2", col_sort=["ADDRESS"], col_order=["ASC"])
+    total = len(sorted_sites['records'])
+    first = await db.list_sites(tenant="test2", col_sort=["ADDRESS"], col_order=["ASC"], page=0, limit=total)
+    assert first['total_records'] == total
+    # An empty page falls back to a separate count with the same filters
+    empty = await db.list_sites(tenant="test2", col_sort=["ADDRESS"], col_order=["ASC"], page=1, limit=total)
+    assert empty['records'] == []
+    assert empty['total_records'] == total
+    before = await db.list_sites(tenant="test2", as_of=datetime(2000, 1, 1), page=0, limit=5)
+    assert before['total_records'] == 0
+
 @pytest.mark.asyncio
 async def test_get_site(db: DBClientProtocol, get_site):
     await db.init_client()
@@ -363,6 +776,99 @@ async def test_get_site(db: DBClientProtocol, get_site):
     assert output[0].site_key == siteSchema.site_key
     assert output is not None
 
+@pytest.mark.asyncio
+async def test_get_site_query_count(db: DBClientProtocol, multiple_devices_2):
+    await db.init_client()
+    site = Site(name="qc_site", latitud=19.4, longitud=-99.1, address="Query count 1")
+    new_site = await db.create_site(tenant="test2", site=site, origin='test_get_db')
+    devices = []
+    for dev in multiple_devices_2:
+        devices.append(await db.create_device(tenant="test2", device=Device(**dev), origin='test_get_db'))
+    if new_site is not None:
+        await db.add_devices_to_site("test2", new_site[0], devices, "test_get_db")
+    await db.get_site(tenant="test2", site_key=site.site_key)
+    db.site_cache.clear()
+    with count_queries() as statements:
+        output_site, output_devices = await db.get_site(tenant="test2", site_key=site.site_key)
+    assert output_site.site_key == site.site_key
+    assert len(output_devices) == len(multiple_devices_2)
+    # Site + satellite + geo, then devices with gen info and ssh config
+    assert len(statements) == 2
+
+@pytest.mark.asyncio
+async def test_get_site_cache(db: DBClientProtocol):
+    await db.init_client()
+    name = unique_name("cached_site")
+    site = Site(name=name, latitud=19.4, longitud=-99.1, address="Cache street 1")
+    new_site = await db.create_site(tenant="test2", site=site, origin='test_get_db')
+    await db.get_site(tenant="test2", site_key=site.site_key)
+    with count_queries() as cached_read:
+        cached = await db.get_site(tenant="test2", site_key=site.site_key)
+    assert cached[0].site_key == site.site_key
+    assert len(cached_read) == 0
+    # Linking devices invalidates the entry
+    devices = []
+    for i in range(3):
+        device = Device(vendor="cache_vendor", serial_number=f"{name}_{i}", status=DeviceStatus.ACTIVE)
+        devices.append(await db.create_device(tenant="test2", device=device, origin='test_get_db'))
+    await db.add_devices_to_site("test2", new_site[0], devices, "test_get_db")
+    with count_queries() as fresh_read:
+        fresh = await db.get_site(tenant="test2", site_key=site.site_key)
+    assert len(fresh_read) > 0
+    assert len(fresh[1]) == len(devices)
+
+@pytest.mark.asyncio
+async def test_get_site_cache_invalidated_during_read(db: DBClientProtocol, monkeypatch):
+    await db.init_client()
+    site = Site(name=f"racing_site_{datetime.now().timestamp()}", address="Race street 1")
+    await db.create_site(tenant="test2", site=site, origin='test_get_db')
+    schema = await db.cached_tenant_schema("test2")
+    db.site_cache.clear()
+    site_from_hub = db._site_from_hub
+
+    def invalidated_while_loading(hub_site, fields=None):
+        # A write commits and invalidates the key after the row was read
+        db._invalidate_site(schema, site.site_key)
+        return site_from_hub(hub_site, fields)
+
+    monkeypatch.setattr(db, "_site_from_hub", invalidated_while_loading)
+    output = await db.get_site(tenant="test2", site_key=site.site_key)
+    assert output[0].site_key == site.site_key
+    # The possibly stale read is not put back in the cache
+    assert db.site_cache.lookup((schema, site.site_key)) == (False, None)
+    monkeypatch.undo()
+    await db.get_site(tenant="test2", site_key=site.site_key)
+    assert db.site_cache.lookup((schema, site.site_key))[0] is True
+
+@pytest.mark.asyncio
+async def test_get_sites(db: DBClientProtocol):
+    await db.init_client()
+    await create_sites_with_devices(db, "batch_site", total_sites=6, devices_per_site=1)
+    site_keys = [Site(name=f"batch_site_{i}").site_key for i in range(6)]
+    db.site_cache.clear()
+    with count_queries() as statements:
+        output = await db.get_sites("test2", site_keys + site_keys[:2] + ["not-a-site"])
+    assert set(output.keys()) == set(site_keys)
+    assert all(len(devices) == 1 for site, devices in output.values())
+    assert len(statements) == 2
+
+@pytest.mark.asyncio
+async def test_get_site_projection(db: DBClientProtocol, get_site):
+    await db.init_client()
+    siteSchema = Site(**get_site)
+    await db.create_site(tenant="test2", site=siteSchema, origin='test_get_db')
+    await db.get_site(tenant="test2", site_key=siteSchema.site_key)
+    db.site_cache.clear()
+    with count_queries() as full_read:
+        full_site, full_devices = await db.get_site(tenant="test2", site_key=siteSchema.site_key)
+    db.site_cache.clear()
+    with count_queries() as map_read:
+        map_site, map_devices = await db.get_site(tenant="test2", site_key=siteSchema.site_key, fields={'site_key', 'name', 'latitud', 'longitud'})
+    assert map_site.latitud == full_site.latitud
+    assert map_site.name == full_site.name
+    assert map_devices == []
+    assert len(map_read) < len(full_read)
+
 @pytest.mark.asyncio
 async def test_associate_devices(db: DBClientProtocol, multiple_devices_2, data_site_3):
     await db.init_client()
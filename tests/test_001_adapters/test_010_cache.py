@@ -0,0 +1,91 @@
+import pytest
+from time import sleep
+
+from device_inventory.adapters.db.cache import TTLCache
+from device_inventory.protocols.db import DBClientProtocol
+from test.fixture import db
+
+
+def test_cache_hit_and_miss():
+    cache = TTLCache(ttl=60)
+    assert cache.lookup('tenant') == (False, None)
+    cache.set('tenant', 'schema')
+    assert cache.lookup('tenant') == (True, 'schema')
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+def test_cache_negative_entry():
+    cache = TTLCache(ttl=60)
+    cache.set('unknown', None)
+    assert cache.lookup('unknown') == (True, None)
+
+def test_cache_expiration():
+    cache = TTLCache(ttl=0.01)
+    cache.set('tenant', 'schema')
+    sleep(0.02)
+    assert cache.lookup('tenant') == (False, None)
+    assert len(cache) == 0
+
+def test_cache_lru_bound():
+    cache = TTLCache(ttl=60, maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.lookup('b') == (False, None)
+    assert cache.lookup('a') == (True, 1)
+
+def test_cache_generation_skips_stale_set():
+    cache = TTLCache(ttl=60)
+    generation = cache.generation('site')
+    cache.invalidate('site')
+    cache.set('site', 'stale', generation=generation)
+    assert cache.lookup('site') == (False, None)
+    cache.set('site', 'fresh', generation=cache.generation('site'))
+    assert cache.lookup('site') == (True, 'fresh')
+
+def test_cache_generation_forgotten_keys():
+    cache = TTLCache(ttl=60)
+    cache.GENERATIONS_SIZE = 1
+    generation = cache.generation('a')
+    cache.invalidate('a')
+    cache.invalidate('b')
+    # 'a' is no longer tracked, the floor still tells the load is stale
+    cache.set('a', 'stale', generation=generation)
+    assert cache.lookup('a') == (False, None)
+
+@pytest.mark.asyncio
+async def test_tenant_schema_cache(db: DBClientProtocol):
+    await db.init_client()
+    db.invalidate_tenant_schema()
+    before = db.tenant_schema_cache_stats()
+    schema = await db.cached_tenant_schema("test2")
+    again = await db.cached_tenant_schema("test2")
+    after = db.tenant_schema_cache_stats()
+    assert schema == again
+    assert after['misses'] == before['misses'] + 1
+    assert after['hits'] == before['hits'] + 1
+
+@pytest.mark.asyncio
+async def test_tenant_schema_cache_unknown_tenant(db: DBClientProtocol):
+    await db.init_client()
+    assert await db.cached_tenant_schema("does-not-exist") is None
+    found, schema = db.tenant_schema_cache.lookup("does-not-exist")
+    assert found is True
+    assert schema is None
+
+@pytest.mark.asyncio
+async def test_resolve_tenant(db: DBClientProtocol):
+    await db.init_client()
+    tenant, reason = await db.resolve_tenant(None, "test2")
+    assert tenant == "test2"
+    assert reason is None
+    db.invalidate_tenant_schema()
+    before = db.tenant_schema_cache_stats()
+    tenant, reason = await db.resolve_tenant("test2", "test2")
+    assert tenant == "test2"
+    # The same identifier twice is a single lookup
+    assert db.tenant_schema_cache_stats()['misses'] == before['misses'] + 1
+    tenant, reason = await db.resolve_tenant("does-not-exist", "does-not-exist-either")
+    assert tenant is None
+    assert reason == 'not_found'
@@ -0,0 +1,64 @@
+import pytest
+from datetime import datetime
+
+from device_inventory.adapters.db.geo import GeoDictionary, normalize_geo_name
+from device_inventory.models.device_properties import Site
+from device_inventory.protocols.db import DBClientProtocol
+from test.fixture import db
+from test_003_hub_site import count_queries, ensure_geo, unique_name
+
+
+def test_normalize_geo_name():
+    assert normalize_geo_name("México") == "mexico"
+    assert normalize_geo_name("  Ciudad   de  MÉXICO ") == "ciudad de mexico"
+    assert normalize_geo_name("Straße") == normalize_geo_name("STRASSE")
+
+def test_geo_dictionary_normalized_lookup():
+    dictionary = GeoDictionary()
+    dictionary.add('country', 'mexico', 'key_1')
+    dictionary.add('country', 'México', 'key_2')
+    # Exact names keep their own row, variants fall back to the first one loaded
+    assert dictionary.key('country', 'México') == 'key_2'
+    assert dictionary.key('country', 'MEXICO ') == 'key_1'
+    assert dictionary.key('country', 'Canada') is None
+    assert dictionary.name('country', 'key_2') == 'México'
+
+def test_geo_dictionary_hierarchy():
+    dictionary = GeoDictionary(complete=True)
+    dictionary.add_link('mx', 'cdmx', 'coyoacan', 'coyoacan_city')
+    assert dictionary.consistent('mx', 'cdmx', 'coyoacan', 'coyoacan_city')
+    assert not dictionary.consistent('mx', 'cdmx', 'tlalpan', 'coyoacan_city')
+    assert dictionary.consistent('mx', 'jalisco', 'zapopan', 'zapopan_city')
+
+@pytest.mark.asyncio
+async def test_resolve_geo_normalized_names(db: DBClientProtocol):
+    await db.init_client()
+    geo = {"country": "Norm País", "state": "Norm Estado", "municipality": "Norm Municipio", "city": "Norm Ciudad"}
+    await ensure_geo(db, **geo)
+    exact, _ = await db.resolve_geo("test2", *geo.values())
+    await db.invalidate_geo_cache("test2")
+    keys, consistent = await db.resolve_geo("test2", "norm pais", " NORM  ESTADO", "norm municipio", "Norm Ciudad")
+    assert keys == exact
+    assert consistent is True
+    # The written site reports the stored names, like a later get_site
+    site = Site(name=f"norm_site_{datetime.now().timestamp()}", country="norm pais", state=" NORM  ESTADO",
+                municipality="norm municipio", city="Norm Ciudad")
+    output = await db.create_site(tenant="test2", site=site, origin="test_geo")
+    assert (output[0].country, output[0].state, output[0].municipality, output[0].city) == tuple(geo.values())
+
+@pytest.mark.asyncio
+async def test_resolve_geo_reloads_on_miss(db: DBClientProtocol, monkeypatch):
+    await db.init_client()
+    await db.warm_geo_cache("test2")
+    # Created behind the cached dictionary, like another worker would
+    name = unique_name("Reload")
+    geo = {"country": f"{name} País", "state": f"{name} Estado", "municipality": f"{name} Municipio", "city": f"{name} Ciudad"}
+    await ensure_geo(db, **geo)
+    monkeypatch.setattr(type(db), "GEO_MISS_RELOAD", 0)
+    with count_queries() as statements:
+        keys, consistent = await db.resolve_geo("test2", f"{name.upper()} PAIS", f" {name}  estado",
+                                                f"{name} MUNICIPIO", f"{name.lower()} ciudad")
+    assert len(statements) == 5
+    assert None not in keys
+    assert consistent is True
+    assert keys == (await db.resolve_geo("test2", *geo.values()))[0]
@@ -0,0 +1,23 @@
+from decimal import Decimal
+
+from device_inventory.adapters.db.hashdiff import hashdiff, site_hashdiff
+
+
+def test_hashdiff_canonical_values():
+    assert site_hashdiff(19.4, -99.1, "Street 1", "11400") == site_hashdiff(Decimal("19.4000"), -99.1, "Street 1", "11400")
+    assert len(site_hashdiff(None, None, None, None)) == 32
+
+def test_hashdiff_exact_text():
+    base = site_hashdiff(19.4, -99.1, "Street 1", "11400")
+    assert site_hashdiff(19.4, -99.1, " Street 1 ", "11400") != base
+    assert site_hashdiff(19.4, -99.1, "", "11400") != site_hashdiff(19.4, -99.1, None, "11400")
+
+def test_hashdiff_detects_every_attribute():
+    base = site_hashdiff(19.4, -99.1, "Street 1", "11400")
+    assert site_hashdiff(19.5, -99.1, "Street 1", "11400") != base
+    assert site_hashdiff(19.4, -99.1, "Street 2", "11400") != base
+    assert site_hashdiff(19.4, -99.1, "Street 1", "11401") != base
+    assert site_hashdiff(19.4, -99.1, "Street 1", None) != base
+
+def test_hashdiff_keeps_positions():
+    assert hashdiff("a", None) != hashdiff(None, "a")
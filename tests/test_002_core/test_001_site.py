@@ -269,6 +269,26 @@ async def create_site_devices(actions, tenant_info_fixture: dict, data_site: str
         output_devices.append(dev_)
     return new_site[0].site_key, output_keys, new_site[0], output_devices
 
+@pytest.mark.asyncio
+async def test_init_client_once(actions, monkeypatch):
+    calls = []
+    init_client = actions.db.init_client
+    async def counted_init_client():
+        calls.append(1)
+        await init_client()
+    monkeypatch.setattr(actions.db, 'init_client', counted_init_client)
+    monkeypatch.setattr(actions, '_client_ready', False)
+    await asyncio.gather(actions.init_client(), actions.init_client())
+    await actions.startup(warm_connections=2)
+    assert len(calls) == 1
+
+@pytest.mark.asyncio
+async def test_check_tenant(actions, tenant_info_fixture):
+    tenant = await actions.check_tenant(tenant_info_fixture)
+    assert tenant == tenant_info_fixture['hostname']
+    tenant = await actions.check_tenant({"header": "no-tenant", "hostname": "no-tenant-host"})
+    assert tenant is None
+
 @pytest.mark.asyncio
 async def test_create_minimal_site(actions, one_site, tenant_info_fixture):
     siteSchema = Site(**one_site)
@@ -314,6 +334,31 @@ async def test_list_sites(actions, tenant_info_fixture, multiple_sites):
     assert output is not None
     assert output['records'] is not None
 
+@pytest.mark.asyncio
+async def test_list_sites_keyset(actions, tenant_info_fixture, multiple_sites):
+    for element in multiple_sites:
+        await actions.create_site(tenant_info_fixture, Site(**element), 'core_list')
+    first_page = await actions.list_sites(tenant_info=tenant_info_fixture, first=2)
+    assert len(first_page['records']) == 2
+    assert first_page['has_previous_page'] == False
+    second_page = await actions.list_sites(tenant_info=tenant_info_fixture, first=2, after=first_page['end_cursor'])
+    assert second_page['has_previous_page'] == True
+    first_keys = {record['site'].site_key for record in first_page['records']}
+    second_keys = {record['site'].site_key for record in second_page['records']}
+    assert first_keys.isdisjoint(second_keys)
+
+@pytest.mark.asyncio
+async def test_iter_sites(actions, tenant_info_fixture, multiple_sites):
+    for element in multiple_sites:
+        await actions.create_site(tenant_info_fixture, Site(**element), 'core_list')
+    streamed = []
+    async for batch in actions.iter_sites(tenant_info_fixture, chunk_size=2):
+        assert len(batch) <= 2
+        streamed.extend(record['site'].site_key for record in batch)
+    listed = await actions.list_sites(tenant_info=tenant_info_fixture)
+    assert len(streamed) == len(set(streamed))
+    assert len(streamed) == len(listed['records'])
+
 @pytest.mark.asyncio
 async def test_get_site_wo_devices(actions, get_site, tenant_info_fixture):
     # Create site
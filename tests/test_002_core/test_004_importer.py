@@ -0,0 +1,99 @@
+import asyncio
+import json
+import pytest
+
+from device_inventory.core.importer import SiteImporter, load_checkpoint, parse_site, read_rows, save_checkpoint
+from test.fixture import actions
+
+
+@pytest.fixture
+def tenant_info_fixture():
+    return {
+        "header": None,
+        "hostname": "test-core-hostname"
+    }
+
+@pytest.fixture
+def sites_csv(tmp_path):
+    path = tmp_path / "sites.csv"
+    lines = ["name,latitud,longitud,address,zip_code"]
+    lines += [f"import_site_{i},19.4,-99.1,Import street {i},11405" for i in range(7)]
+    lines += ["import_site_bad,19.4,,Import street bad,11405"]
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return str(path)
+
+
+def test_read_rows_jsonl(tmp_path):
+    path = tmp_path / "sites.jsonl"
+    path.write_text('{"name": "a"}\n\n{"name": "b", "latitud": "19.4"}\n', encoding="utf-8")
+    rows = list(read_rows(str(path)))
+    assert [line for line, row in rows] == [1, 3]
+    assert parse_site(rows[1][1]).latitud == 19.4
+
+def test_parse_site_blank_cells():
+    site = parse_site({"name": "blank_cells", "address": " ", "zip_code": ""})
+    assert site.address is None
+    assert site.zip_code is None
+
+@pytest.mark.asyncio
+async def test_import_sites(actions, tenant_info_fixture, sites_csv):
+    await actions.init_client()
+    importer = SiteImporter(actions, tenant_info_fixture, 'core_import', chunk_size=3, max_in_flight=1,
+                            checkpoint_path=f"{sites_csv}.checkpoint")
+    report = await importer.run(sites_csv)
+    assert report['rows'] == 8
+    assert report['created'] + report['exists'] == 7
+    assert report['failed'] == 1
+    assert report['error_rows'][0]['line'] == 9
+    assert report['error_rows'][0]['status'] == 'invalid'
+    assert report['rows_per_second'] > 0
+
+@pytest.mark.asyncio
+async def test_import_sites_resume(actions, tenant_info_fixture, sites_csv):
+    await actions.init_client()
+    checkpoint_path = f"{sites_csv}.checkpoint"
+    save_checkpoint(checkpoint_path, 6)
+    importer = SiteImporter(actions, tenant_info_fixture, 'core_import', chunk_size=3, checkpoint_path=checkpoint_path)
+    report = await importer.run(sites_csv)
+    assert report['resumed_from'] == 6
+    assert report['rows'] == 2
+
+@pytest.mark.asyncio
+async def test_import_sites_failed_chunk_resumes(actions, tenant_info_fixture, sites_csv, monkeypatch):
+    await actions.init_client()
+    checkpoint_path = f"{sites_csv}.checkpoint"
+    create_sites = actions.create_sites
+
+    async def failing_second_chunk(tenant_info, sites, origin, **kwargs):
+        if any(site.name == "import_site_3" for site in sites):
+            return [{"site_key": site.site_key, "status": "error", "error": "rolled back", "site": None} for site in sites]
+        return await create_sites(tenant_info, sites, origin, **kwargs)
+
+    monkeypatch.setattr(actions, "create_sites", failing_second_chunk)
+    importer = SiteImporter(actions, tenant_info_fixture, 'core_import', chunk_size=3, max_in_flight=1, writers=1,
+                            checkpoint_path=checkpoint_path)
+    report = await importer.run(sites_csv)
+    assert report['failed_chunks'] == 1
+    # Only the chunk before the failed one is behind the checkpoint
+    assert load_checkpoint(checkpoint_path) == 3
+
+    monkeypatch.setattr(actions, "create_sites", create_sites)
+    importer = SiteImporter(actions, tenant_info_fixture, 'core_import', chunk_size=3, checkpoint_path=checkpoint_path)
+    report = await importer.run(sites_csv)
+    assert report['resumed_from'] == 3
+    assert report['created'] + report['exists'] == 4
+    assert report['failed_chunks'] == 0
+    assert load_checkpoint(checkpoint_path) == 0
+
+@pytest.mark.asyncio
+async def test_import_sites_writer_raises(actions, tenant_info_fixture, sites_csv, monkeypatch):
+    await actions.init_client()
+
+    async def broken(*args, **kwargs):
+        raise RuntimeError("database is gone")
+
+    monkeypatch.setattr(actions, "create_sites", broken)
+    importer = SiteImporter(actions, tenant_info_fixture, 'core_import', chunk_size=1, max_in_flight=1, writers=1)
+    # The reader is blocked on the full queue when the writer dies, run must still return
+    with pytest.raises(RuntimeError):
+        await asyncio.wait_for(importer.run(sites_csv), timeout=10)
@@ -248,6 +248,36 @@ async def test_create_site(asyncApp: asyncApp):
     assert response_body['data']['create_site']['edge']['cursor'] is not None
     assert response_body['data']['create_site']['errors'] == None
 
+@pytest.mark.asyncio
+async def test_create_sites(asyncApp: asyncApp):
+    headers = {
+        "tenant": "http://testserver/"
+    }
+    async with AsyncClient(app=asyncApp, base_url="http://") as ac:
+        query= """
+        mutation create_sites {
+    create_sites(sites: [{name: "bulk_graphql_1", address: "Gabriel Mancera 81"}, {name: "bulk_graphql_2", latitud: 80}], origin: "create_grap") {
+        errors
+        created
+        outcomes {
+            site_key
+            status
+            node {
+                name
+                address
+            }
+        }
+    }
+    }
+"""
+        response = await ac.post("/api/v2/graphql/", json={"query": query}, headers=headers)
+    assert response.status_code == 200
+    response_body = response.json()
+    outcomes = response_body['data']['create_sites']['outcomes']
+    assert outcomes[0]['status'] in ('created', 'exists')
+    assert outcomes[1]['status'] == 'invalid'
+    assert outcomes[1]['node'] is None
+
 @pytest.mark.asyncio
 async def test_associate_devices_to_site(asyncApp: asyncApp, data_site, multiple_devices, actions, tenant_info_fixture):
     site_key, formatted_keys, output_keys, new_site = await create_site_devices(actions, tenant_info_fixture, data_site, multiple_devices)
@@ -416,5 +446,24 @@ async def test_list_sites(asyncApp: asyncApp, multiple_sites, actions, tenant_in
     ic(response_body)
     assert response_body['data']['sites']['edges'] is not None
 
-
-    
\ No newline at end of file
+@pytest.mark.asyncio
+async def test_get_aliased_sites(asyncApp: asyncApp, multiple_sites, actions, tenant_info_fixture):
+    site_keys = []
+    for element in multiple_sites:
+        siteSchema = Site(**element)
+        await actions.create_site(tenant_info_fixture, siteSchema, 'web_alias')
+        site_keys.append(siteSchema.site_key)
+    headers = {
+        "tenant": "http://testserver/"
+    }
+    fields = "".join(
+        f"""s{i}: site(site_key:"{site_key}") {{ errors edge {{ cursor node {{ site_key name }} }} }}\n"""
+        for i, site_key in enumerate(site_keys)
+    )
+    query = f"query aliased_sites {{\n{fields}}}"
+    async with AsyncClient(app=asyncApp, base_url="http://") as ac:
+        response = await ac.post("/api/v2/graphql/", json={"query": query}, headers=headers)
+    assert response.status_code == 200
+    response_body = response.json()
+    for i, site_key in enumerate(site_keys):
+        assert response_body['data'][f's{i}']['edge']['cursor'] == site_key
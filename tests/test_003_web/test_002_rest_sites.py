@@ -0,0 +1,67 @@
+import pytest
+import json
+from uuid import uuid4
+from fastapi import FastAPI
+from httpx import AsyncClient
+from device_inventory.adapters.web import rest_sites
+from device_inventory.adapters.web.rest_sites import ndjson_sites, router
+from device_inventory.core.container import ActionsContainer
+from device_inventory.models.device_properties import Site
+from test.fixture import actions
+
+
+@pytest.fixture
+def tenant_info_fixture():
+    return {
+        "header": None,
+        "hostname": "http://testserver/"
+    }
+
+@pytest.fixture
+def export_sites_fixture():
+    prefix = f"export_site_{uuid4().hex[:12]}"
+    return [Site(name=f"{prefix}_{i}", latitud=19.4, longitud=-99.1, address=f"Export street {i}") for i in range(3)]
+
+@pytest.fixture
+def container():
+    # The app factory lives outside this module, a bare app with the router is enough here
+    container = ActionsContainer()
+    container.wire(modules=[rest_sites])
+    yield container
+    container.unwire()
+
+@pytest.fixture
+def rest_app(container):
+    app = FastAPI()
+    app.include_router(router, prefix="/api/v2")
+    return app
+
+
+@pytest.mark.asyncio
+async def test_ndjson_sites(actions, tenant_info_fixture, export_sites_fixture):
+    await actions.init_client()
+    await actions.create_sites(tenant_info_fixture, export_sites_fixture, 'rest_export')
+    lines = []
+    async for chunk in ndjson_sites(actions, tenant_info_fixture, chunk_size=2):
+        lines += [json.loads(line) for line in chunk.splitlines() if line]
+    exported = {line['name']: line for line in lines}
+    for site in export_sites_fixture:
+        assert exported[site.name]['address'] == site.address
+
+@pytest.mark.asyncio
+async def test_export_sites(rest_app, container, tenant_info_fixture, export_sites_fixture):
+    actions = container.actions()
+    await actions.init_client()
+    await actions.create_sites(tenant_info_fixture, export_sites_fixture, 'rest_export')
+    async with AsyncClient(app=rest_app, base_url="http://testserver") as ac:
+        response = await ac.get("/api/v2/sites/export?chunk_size=2")
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith("application/x-ndjson")
+    exported_names = {json.loads(line)['name'] for line in response.text.splitlines() if line}
+    assert {site.name for site in export_sites_fixture} <= exported_names
+
+@pytest.mark.asyncio
+async def test_export_sites_unknown_tenant(rest_app):
+    async with AsyncClient(app=rest_app, base_url="http://does-not-exist") as ac:
+        response = await ac.get("/api/v2/sites/export", headers={"tenant": "does-not-exist-either"})
+    assert response.status_code == 404